@@ -7,6 +7,12 @@ algorithms. It aims to provide efficient approximation alternatives
 to exact solutions to data mining and data integration problems.
 """
 from datasketch.hyperloglog import HyperLogLog, HyperLogLogPlusPlus
+from datasketch.hyperloglog_collection import HLLCollection
 from datasketch.minhash import MinHash
-from datasketch.b_bit_minhash import bBitMinHash
+from datasketch.minhash_batch import MinHashBatch
+from datasketch.b_bit_minhash import bBitMinHash, bBitMinHashBatch
+from datasketch.weighted_minhash import WeightedMinHash, WeightedMinHashGenerator
 from datasketch.lsh import LSH
+from datasketch.lsh_forest import LSHForest
+from datasketch.lsh_ensemble import LSHEnsemble
+from datasketch.sharded_lsh import ShardedLSH
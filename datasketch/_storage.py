@@ -0,0 +1,61 @@
+'''
+Private helpers shared by the collections of sketches and the indexes
+that store their signatures or registers as the rows of one matrix, and
+number their keys in insertion order.
+'''
+
+import numpy as np
+
+
+def _reserve_rows(array, size, n):
+    '''
+    Make room for `n` more rows after the first `size` rows of `array`.
+    Returns `array` if it has room and is writeable, otherwise a new
+    zero-filled array with the first `size` rows copied and at least double
+    the capacity, so that appending rows one at a time takes amortized
+    constant time.
+    '''
+    capacity = array.shape[0]
+    if size + n <= capacity and array.flags.writeable:
+        return array
+    grown = np.zeros((max(size + n, 2 * capacity),) + array.shape[1:],
+            dtype=array.dtype)
+    grown[:size] = array[:size]
+    return grown
+
+
+def _check_signature_matrix(signature_matrix, num_perm):
+    '''
+    Get the hash values of a MinHashBatch, or of any object with a matrix
+    of `hashvalues`, or a 2-dimensional array of signatures, checking that
+    they have `num_perm` hash values each.
+    '''
+    signature_matrix = getattr(signature_matrix, 'hashvalues',
+            signature_matrix)
+    signature_matrix = np.asarray(signature_matrix)
+    if signature_matrix.ndim != 2 or signature_matrix.shape[1] != num_perm:
+        raise ValueError("Expecting a matrix of signatures with %d permutation functions"
+                % num_perm)
+    return signature_matrix
+
+
+def _check_new_keys(keys, existing):
+    '''
+    Check that the list of `keys` has no repeated keys and none of the
+    keys in `existing`.
+    '''
+    if len(set(keys)) != len(keys) or any(key in existing for key in keys):
+        raise ValueError("The given keys already exist or are repeated")
+
+
+def _add_keys(keys, ids, new_keys):
+    '''
+    Number the list of `new_keys` after the ones in the list `keys`, in
+    order, appending them to `keys` and adding them to the dict `ids` from
+    key to number. Returns the number of the first new key.
+    '''
+    _check_new_keys(new_keys, ids)
+    start = len(keys)
+    keys.extend(new_keys)
+    ids.update(zip(new_keys, range(start, len(keys))))
+    return start
@@ -7,14 +7,90 @@ of each minimum hashed value, without significant loss of accuracy.
 '''
 
 import struct 
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
+
+def _pack(hashvalues, slot_size):
+    '''
+    Pack the b-bit hash values along the last axis of `hashvalues` into
+    uint64 blocks of 64 / `slot_size` slots each, with the first hash
+    value of a block in its highest slot. The last block is zero-padded.
+    '''
+    n = 64 // slot_size
+    num_perm = hashvalues.shape[-1]
+    num_blocks = -(-num_perm // n)
+    shape = hashvalues.shape[:-1]
+    if slot_size == 1:
+        bits = np.zeros(shape + (num_blocks * n,), dtype=np.uint8)
+        bits[..., :num_perm] = hashvalues
+        # packbits puts the first bit in the highest bit of each byte,
+        # so the bytes of a block are in big-endian order
+        return np.packbits(bits, axis=-1).view('>u8').astype(np.uint64)
+    slots = np.zeros(shape + (num_blocks * n,), dtype=np.uint64)
+    slots[..., :num_perm] = hashvalues
+    slots = slots.reshape(shape + (num_blocks, n))
+    shifts = np.arange(n - 1, -1, -1, dtype=np.uint64) * np.uint64(slot_size)
+    return np.bitwise_or.reduce(slots << shifts, axis=-1)
+
+
+def _unpack(blocks, slot_size, num_perm):
+    '''
+    Unpack the first `num_perm` b-bit hash values from the uint64 blocks
+    along the last axis of `blocks`, the inverse of `_pack`.
+    '''
+    n = 64 // slot_size
+    shape = blocks.shape[:-1]
+    if slot_size == 1:
+        bits = np.unpackbits(blocks.astype('>u8').view(np.uint8), axis=-1)
+        return bits[..., :num_perm].astype(np.uint32)
+    shifts = np.arange(n - 1, -1, -1, dtype=np.uint64) * np.uint64(slot_size)
+    mask = np.uint64((1 << slot_size) - 1)
+    slots = (blocks[..., np.newaxis] >> shifts) & mask
+    return slots.reshape(shape + (-1,))[..., :num_perm].astype(np.uint32)
+
+
+# The maximum number of uint64 words in the temporary arrays used by
+# the batch Jaccard estimation
+_batch_max_words = 1 << 20
+
+# For each slot size, the mask of the lowest bit of every slot in a block
+_slot_low_bits = dict((slot_size, np.uint64(sum(1 << i
+    for i in range(0, 64, slot_size)))) for slot_size in (1, 2, 4, 8, 16, 32))
+
+# Count the number of 1 bits in an array of uint64, summed over the last axis
+if hasattr(np, 'bitwise_count'):
+    _popcount = lambda words : np.bitwise_count(words).sum(axis=-1)
+else:
+    # For numpy < 2.0, count the bits of every byte using a lookup table
+    _popcount_table = np.array([bin(i).count('1') for i in range(256)],
+            dtype=np.uint8)
+    _popcount = lambda words : _popcount_table[np.ascontiguousarray(words)\
+            .view(np.uint8)].sum(axis=-1)
+
+
+def _count_mismatches(blocks1, blocks2, slot_size):
+    '''
+    Count the slots that differ between the packed blocks `blocks1` and
+    `blocks2`, along the last axis.
+    '''
+    x = np.bitwise_xor(blocks1, blocks2)
+    if slot_size > 1:
+        # Fold the bits of every slot into its lowest bit
+        shift = 1
+        while shift < slot_size:
+            x |= x >> np.uint64(shift)
+            shift *= 2
+        x &= _slot_low_bits[slot_size]
+    return _popcount(x)
+
+
 class bBitMinHash(object):
     '''
     The b-bit MinHash object
     '''
 
-    __slots__ = ('seed', 'b', 'r', 'hashvalues')  
+    __slots__ = ('seed', 'b', 'r', 'num_perm', 'blocks', 'a')
 
     # seed as int64
     # b as uint8
@@ -23,6 +99,7 @@ class bBitMinHash(object):
     _serial_fmt_params = '<qBdi'
     # each block as uint64
     _serial_fmt_block = 'Q'
+    _serial_dtype_block = np.dtype('<u8')
 
     def __init__(self, minhash, b=1, r=0.0):
         '''
@@ -37,37 +114,54 @@ class bBitMinHash(object):
         if r > 1.0:
             raise ValueError("r must be a float in [0.0, 1.0]")
         bmask = (1 << b) - 1
-        self.hashvalues = np.bitwise_and(minhash.hashvalues, bmask)\
-                .astype(np.uint32)
+        hashvalues = np.bitwise_and(minhash.hashvalues, bmask)
+        # Keep the b-bit hash values packed in uint64 blocks
+        self.blocks = _pack(hashvalues, self._find_slot_size(b))
+        self.num_perm = hashvalues.size
         self.seed = minhash.seed
         self.b = b
         self.r = r
+        # The value of A(r, b) for the correction of the Jaccard estimates
+        self.a = self._calc_a(r, b)
+
+    @property
+    def hashvalues(self):
+        '''
+        The b-bit hash values, unpacked into a uint32 array.
+        '''
+        return _unpack(self.blocks, self._find_slot_size(self.b),
+                self.num_perm)
 
     def __eq__(self, other):
         '''
         Check for full equality of two b-bit MinHash objects.
         '''
         return self.seed == other.seed and self.b == other.b and \
-                self.r == other.r and \
-                np.array_equal(self.hashvalues, other.hashvalues)
+                self.r == other.r and self.num_perm == other.num_perm and \
+                np.array_equal(self.blocks, other.blocks)
 
     def jaccard(self, other):
         '''
         Estimate the Jaccard similarity (resemblance) between this b-bit
         MinHash and the other.
         '''
+        self._check(other)
+        mismatches = _count_mismatches(self.blocks, other.blocks,
+                self._find_slot_size(self.b))
+        raw_est = float(self.num_perm - mismatches) / float(self.num_perm)
+        c1, c2 = self._calc_c(self.a, other.a, self.r, other.r)
+        return (raw_est - c1) / (1 - c2) 
+
+    def _check(self, other):
         if self.b != other.b:
             raise ValueError("Cannot compare two b-bit MinHashes with different\
                     b values")
         if self.seed != other.seed:
             raise ValueError("Cannot compare two b-bit MinHashes with different\
                     set of permutations")
-        intersection = np.count_nonzero(self.hashvalues==other.hashvalues)
-        raw_est = float(intersection) / float(self.hashvalues.size)
-        a1 = self._calc_a(self.r, self.b)
-        a2 = self._calc_a(other.r, other.b)
-        c1, c2 = self._calc_c(a1, a2, self.r, other.r)
-        return (raw_est - c1) / (1 - c2) 
+        if self.num_perm != other.num_perm:
+            raise ValueError("Cannot compare two b-bit MinHashes with different\
+                    numbers of hash values")
 
     def bytesize(self):
         '''
@@ -81,20 +175,13 @@ class bBitMinHash(object):
         Returns a bytearray which will then be pickled.
         '''
         slot_size, n, num_blocks, total = self._bytesize()
-        buffer = bytearray(total)
-        blocks = np.zeros((num_blocks,), dtype=np.uint64)
-        for i in range(num_blocks):
-            # Obtain the current segment of n hashed values
-            start = i * n
-            hvs = self.hashvalues[start:start+n]
-            # Store the n b-bit hashed values in the current block 
-            for j, hv in enumerate(hvs):
-                blocks[i] |= np.uint64(hv << (n - 1 - j) * slot_size)
-        fmt = self._serial_fmt_params + \
-                "%d%s" % (num_blocks, self._serial_fmt_block)
-        struct.pack_into(fmt, buffer, 0, self.seed, self.b, self.r, \
-                self.hashvalues.size, *blocks)
-        return buffer
+        buf = bytearray(total)
+        struct.pack_into(self._serial_fmt_params, buf, 0, self.seed, self.b,
+                self.r, self.num_perm)
+        offset = struct.calcsize(self._serial_fmt_params)
+        np.frombuffer(buf, dtype=self._serial_dtype_block, count=num_blocks,
+                offset=offset)[:] = self.blocks
+        return buf
 
     def __setstate__(self, buf):
         '''
@@ -102,28 +189,20 @@ class bBitMinHash(object):
         Initialize the object with data in the buffer.
         '''
         try:
-            self.seed, self.b, self.r, num_perm = \
+            self.seed, self.b, self.r, self.num_perm = \
                     struct.unpack_from(self._serial_fmt_params, buf, 0)
         except TypeError:
-            self.seed, self.b, self.r, num_perm = \
+            self.seed, self.b, self.r, self.num_perm = \
                     struct.unpack_from(self._serial_fmt_params, buffer(buf), 0)
         offset = struct.calcsize(self._serial_fmt_params)
-        self.hashvalues = np.zeros((num_perm,), dtype=np.uint32)
-        # Reconstruct the hash values
         slot_size, n, num_blocks, total = self._bytesize()
-        fmt = "%d%s" % (num_blocks, self._serial_fmt_block)
-        try:
-            blocks = struct.unpack_from(fmt, buf, offset)
-        except TypeError:
-            blocks = struct.unpack_from(fmt, buffer(buf), offset)
-        mask = (1 << slot_size) - 1
-        for i in range(num_blocks):
-            start = i * n
-            for j, _ in enumerate(self.hashvalues[start:start+n]):
-                hv = (blocks[i] >> (n - 1 - j) * slot_size) & mask
-                self.hashvalues[start+j] = np.uint32(hv)
+        # Copy the blocks, which are not aligned in the buffer
+        self.blocks = np.frombuffer(buf, dtype=self._serial_dtype_block,
+                count=num_blocks, offset=offset).astype(np.uint64)
+        self.a = self._calc_a(self.r, self.b)
 
-    def _calc_a(self, r, b):
+    @staticmethod
+    def _calc_a(r, b):
         '''
         Compute the function A(r, b)
         '''
@@ -132,7 +211,8 @@ class bBitMinHash(object):
             return 1.0 / (1 << b)
         return r * (1 - r) ** (2 ** b - 1) / (1 - (1 - r) ** (2 * b))
 
-    def _calc_c(self, a1, a2, r1, r2):
+    @staticmethod
+    def _calc_c(a1, a2, r1, r2):
         '''
         Compute the functions C1 and C2
         '''
@@ -147,7 +227,8 @@ class bBitMinHash(object):
         c2 = (a1 * r1 + a2 * r2) * div
         return c1, c2
     
-    def _find_slot_size(self, b):
+    @staticmethod
+    def _find_slot_size(b):
         if b == 1:
             return 1
         if b == 2:
@@ -169,9 +250,187 @@ class bBitMinHash(object):
         # Get the number of slots to be stored in each block
         num_slots_per_block = int(block_size * 8 / slot_size)
         # Get the number of blocks required
-        num_blocks = int(np.ceil(float(self.hashvalues.size) /\
+        num_blocks = int(np.ceil(float(self.num_perm) /\
                 num_slots_per_block))
         # Get the total serialized size
         total = struct.calcsize(self._serial_fmt_params + \
                 "%d%s" % (num_blocks, self._serial_fmt_block))
         return slot_size, num_slots_per_block, num_blocks, total
+
+
+# seed as int64
+# b as uint8
+# num_perm as int32
+# number of b-bit MinHashes as int64
+_serial_fmt_batch_params = '<qBiq'
+
+
+def serialize_batch(bbmhs):
+    '''
+    Serialize a list of b-bit MinHash objects with the same seed, b and
+    number of hash values into one contiguous bytearray.
+    The format is a header, followed by the r values of all b-bit MinHash
+    objects as float64, followed by their packed blocks back to back.
+    '''
+    if len(bbmhs) == 0:
+        raise ValueError("Cannot serialize an empty list of b-bit MinHashes")
+    first = bbmhs[0]
+    num_perm = first.num_perm
+    if any(m.seed != first.seed or m.b != first.b or \
+            m.num_perm != num_perm for m in bbmhs):
+        raise ValueError("The b-bit MinHashes must have the same seed, b and\
+                number of hash values")
+    blocks = np.vstack([m.blocks for m in bbmhs])
+    rs = np.array([m.r for m in bbmhs], dtype='<f8')
+    offset = struct.calcsize(_serial_fmt_batch_params)
+    buf = bytearray(offset + rs.nbytes + blocks.size * 8)
+    struct.pack_into(_serial_fmt_batch_params, buf, 0, first.seed, first.b,
+            num_perm, len(bbmhs))
+    np.frombuffer(buf, dtype='<f8', count=rs.size, offset=offset)[:] = rs
+    offset += rs.nbytes
+    np.frombuffer(buf, dtype=bBitMinHash._serial_dtype_block,
+            count=blocks.size, offset=offset)[:] = blocks.ravel()
+    return buf
+
+
+def deserialize_batch(buf):
+    '''
+    Reconstruct the list of b-bit MinHash objects serialized in `buf` by
+    `serialize_batch`.
+    '''
+    try:
+        seed, b, num_perm, size = \
+                struct.unpack_from(_serial_fmt_batch_params, buf, 0)
+    except TypeError:
+        seed, b, num_perm, size = \
+                struct.unpack_from(_serial_fmt_batch_params, buffer(buf), 0)
+    offset = struct.calcsize(_serial_fmt_batch_params)
+    rs = np.frombuffer(buf, dtype='<f8', count=size, offset=offset)
+    offset += rs.nbytes
+    slot_size = bBitMinHash._find_slot_size(b)
+    num_blocks = -(-num_perm // (64 // slot_size))
+    blocks = np.frombuffer(buf, dtype=bBitMinHash._serial_dtype_block,
+            count=size*num_blocks, offset=offset).astype(np.uint64)
+    blocks = blocks.reshape(size, num_blocks)
+    bbmhs = []
+    for r, row in zip(rs, blocks):
+        m = bBitMinHash.__new__(bBitMinHash)
+        m.seed, m.b, m.r, m.num_perm, m.blocks = seed, b, float(r), \
+                num_perm, row
+        m.a = m._calc_a(m.r, b)
+        bbmhs.append(m)
+    return bbmhs
+
+
+def _calc_c_batch(a1, a2, r1, r2):
+    '''
+    Compute the functions C1 and C2 as in bBitMinHash._calc_c, for arrays
+    of values broadcast against each other.
+    '''
+    rsum = r1 + r2
+    zero = rsum == 0.0
+    # The limits are A1 and A2 when r1 = r2 = 0
+    div = 1.0 / np.where(zero, 1.0, rsum)
+    c1 = np.where(zero, a1, (a1 * r2 + a2 * r1) * div)
+    c2 = np.where(zero, a2, (a1 * r1 + a2 * r2) * div)
+    return c1, c2
+
+
+class bBitMinHashBatch(object):
+    '''
+    A collection of b-bit MinHash objects with the same seed, b and number
+    of hash values, stored as one matrix of packed blocks with a row for
+    each b-bit MinHash, for estimating Jaccard similarities in batch.
+    '''
+
+    __slots__ = ('seed', 'b', 'num_perm', 'blocks', 'r', 'a')
+
+    def __init__(self, bbmhs):
+        '''
+        Create a batch from a non-empty list of b-bit MinHash objects.
+        '''
+        if len(bbmhs) == 0:
+            raise ValueError("Cannot create a batch from an empty list of\
+                    b-bit MinHashes")
+        first = bbmhs[0]
+        for m in bbmhs:
+            first._check(m)
+        self.seed = first.seed
+        self.b = first.b
+        self.num_perm = first.num_perm
+        self.blocks = np.vstack([m.blocks for m in bbmhs])
+        self.r = np.array([m.r for m in bbmhs], dtype=np.float64)
+        self.a = np.array([m.a for m in bbmhs], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, i):
+        '''
+        Get the i-th b-bit MinHash in this batch.
+        '''
+        m = bBitMinHash.__new__(bBitMinHash)
+        m.seed, m.b, m.r, m.num_perm, m.blocks = self.seed, self.b, \
+                float(self.r[i]), self.num_perm, self.blocks[i]
+        m.a = float(self.a[i])
+        return m
+
+    def _estimate(self, mismatches, a1, a2, r1, r2):
+        raw_est = (self.num_perm - mismatches) / float(self.num_perm)
+        c1, c2 = _calc_c_batch(a1, a2, r1, r2)
+        return (raw_est - c1) / (1 - c2)
+
+    def jaccard(self, query):
+        '''
+        Estimate the Jaccard similarities between the b-bit MinHash `query`
+        and every b-bit MinHash in this batch.
+        '''
+        query._check(self[0])
+        slot_size = bBitMinHash._find_slot_size(self.b)
+        mismatches = np.empty(len(self), dtype=np.int64)
+        chunk_size = max(1, _batch_max_words // self.blocks.shape[1])
+        for start in range(0, len(self), chunk_size):
+            end = start + chunk_size
+            mismatches[start:end] = _count_mismatches(self.blocks[start:end],
+                    query.blocks, slot_size)
+        return self._estimate(mismatches, np.float64(query.a), self.a,
+                np.float64(query.r), self.r)
+
+    def jaccard_matrix(self, other=None, block_size=None, threads=None):
+        '''
+        Estimate the Jaccard similarities between all pairs of b-bit
+        MinHashes in this batch and in the batch `other` (this batch
+        itself if not given). Returns a (len(self) x len(other)) matrix.
+        The matrix is computed in square blocks of `block_size` b-bit
+        MinHashes, chosen to bound the size of the temporary arrays if not
+        given. If `threads` is given, the blocks of rows are computed in
+        parallel by a pool of that many threads.
+        '''
+        if other is None:
+            other = self
+        self[0]._check(other[0])
+        slot_size = bBitMinHash._find_slot_size(self.b)
+        if block_size is None:
+            block_size = max(1, int(np.sqrt(_batch_max_words //
+                self.blocks.shape[1])))
+        mismatches = np.empty((len(self), len(other)), dtype=np.int64)
+        def compute_rows(i):
+            b1 = self.blocks[i:i+block_size, np.newaxis, :]
+            for j in range(0, len(other), block_size):
+                b2 = other.blocks[np.newaxis, j:j+block_size, :]
+                mismatches[i:i+block_size, j:j+block_size] = \
+                        _count_mismatches(b1, b2, slot_size)
+        starts = range(0, len(self), block_size)
+        if threads is None:
+            for i in starts:
+                compute_rows(i)
+        else:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(compute_rows, starts)
+            finally:
+                pool.close()
+                pool.join()
+        return self._estimate(mismatches, self.a[:, np.newaxis],
+                other.a[np.newaxis, :], self.r[:, np.newaxis],
+                other.r[np.newaxis, :])
@@ -11,6 +11,7 @@ with enhanced functionalities for serialization and similarities.
 '''
 
 import struct
+from hashlib import sha1
 import numpy as np
 try:
     from .hyperloglog_const import _thresholds, _raw_estimate, _bias
@@ -18,6 +19,15 @@ except ImportError:
     # For Python 2
     from hyperloglog_const import _thresholds, _raw_estimate, _bias
 
+# The bias correction tables as float64 arrays, one for each precision
+_raw_estimate = [np.asarray(v, dtype=np.float64) for v in _raw_estimate]
+_bias = [np.asarray(v, dtype=np.float64) for v in _bias]
+# The nearest neighbors for the bias correction are taken from this many
+# table entries on each side of the position found by binary search,
+# which covers the few out of order entries in the raw estimate tables
+_bias_window = 8
+# The values of 2^-rank for every possible register value
+_inverse_powers = 2.0 ** -np.arange(65)
 
 # Get the number of bits starting from the first non-zero bit to the right
 _bit_length = lambda bits : bits.bit_length()
@@ -26,17 +36,64 @@ if not hasattr(int, 'bit_length'):
     _bit_length = lambda bits : len(bin(bits)) - 2 if bits > 0 else 0
 
 
+def _bit_length_batch(bits):
+    '''
+    Get the bit lengths of an array of unsigned integers of up to 64 bits,
+    using a binary search on the position of the highest non-zero bit.
+    '''
+    bits = bits.astype(np.uint64)
+    length = np.zeros(bits.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = bits >> np.uint64(shift) != 0
+        length[high] += shift
+        bits = np.where(high, bits >> np.uint64(shift), bits)
+    return length + (bits != 0)
+
+
+def _encode_varints(values):
+    '''
+    Encode an array of unsigned integers as variable-length integers of
+    7 bits per byte, with the highest bit set on all but the last byte.
+    '''
+    values = values.astype(np.uint64)
+    if values.size == 0:
+        return b""
+    num_bytes = np.maximum(1, (_bit_length_batch(values) + 6) // 7)
+    k = np.arange(num_bytes.max())
+    groups = ((values[:, np.newaxis] >> (k * 7).astype(np.uint64)) &
+            np.uint64(0x7f)).astype(np.uint8)
+    groups[k < (num_bytes - 1)[:, np.newaxis]] |= 0x80
+    return groups[k < num_bytes[:, np.newaxis]].tobytes()
+
+
+def _decode_varints(buf):
+    '''
+    Decode the variable-length integers encoded by `_encode_varints`.
+    '''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros((0,), dtype=np.uint64)
+    ends = (data & 0x80) == 0
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    # The index of the integer that each byte belongs to
+    which = np.cumsum(ends) - ends
+    shifts = ((np.arange(data.size) - starts[which]) * 7).astype(np.uint64)
+    parts = (data & 0x7f).astype(np.uint64) << shifts
+    return np.add.reduceat(parts, starts)
+
+
 class HyperLogLog(object):
     '''
     The HyperLogLog class.
     '''
 
-    __slots__ = ('p', 'm', 'reg', 'alpha', 'max_rank')
+    __slots__ = ('p', 'm', 'reg', 'alpha', 'max_rank', 'hsum', 'num_zero')
 
     # The range of the hash values used for HyperLogLog
     _hash_range_bit = 32
     _hash_range_byte = 4
     _struct_fmt_str = '<I'
+    _hash_dtype = np.dtype('<u4')
 
     def _get_alpha(self, p):
         if not (4 <= p <= 16):
@@ -49,12 +106,15 @@ class HyperLogLog(object):
             return 0.709
         return 0.7213 / (1.0 + 1.079 / (1 << p))
 
-    def __init__(self, p=8, reg=None):
+    def __init__(self, p=8, reg=None, incremental=False):
         '''
         Create a HyperLogLog with precision parameter `p` and (optionally) a
         register vector `reg`. If `reg` is specified, the constructor will
         use it as the underlying regiser, instead of creating a new one, and
         the `p` parameter value is ignored.
+        If `incremental` is True, the sum of 2^-register and the number of
+        zero registers are updated as the registers change, so that `count`
+        does not need to go over all the registers.
         '''
         if reg is None:
             self.p = p
@@ -76,6 +136,27 @@ class HyperLogLog(object):
         # Common settings
         self.alpha = self._get_alpha(self.p)
         self.max_rank = self._hash_range_bit - self.p
+        self.hsum = None
+        self.num_zero = None
+        if incremental:
+            self._reset_sums()
+
+    def _reset_sums(self):
+        '''
+        Recompute the sums maintained in the incremental mode from the
+        registers.
+        '''
+        self.hsum = np.sum(_inverse_powers[self.reg])
+        self.num_zero = self.m - np.count_nonzero(self.reg)
+
+    def _get_sums(self):
+        '''
+        Get the sum of 2^-register and the number of zero registers.
+        '''
+        if self.hsum is not None:
+            return self.hsum, self.num_zero
+        return np.sum(_inverse_powers[self.reg]), \
+                self.m - np.count_nonzero(self.reg)
 
     def is_empty(self):
         '''
@@ -93,6 +174,13 @@ class HyperLogLog(object):
                     bits" % self.max_rank)
         return rank
 
+    def _get_ranks(self, bits):
+        ranks = self.max_rank - _bit_length_batch(bits) + 1
+        if np.any(ranks <= 0):
+            raise ValueError("Hash value overflow, maximum size is %d\
+                    bits" % self.max_rank)
+        return ranks
+
     def digest(self, hashobj):
         '''
         Digest a hash object that implemented `digest` as in hashlib.
@@ -106,8 +194,62 @@ class HyperLogLog(object):
         reg_index = hv & (self.m - 1)
         # Get the rest of the hash
         bits = hv >> self.p
-        # Update the register
-        self.reg[reg_index] = max(self.reg[reg_index], self._get_rank(bits))
+        # Update the register, copying read-only registers first
+        if not self.reg.flags.writeable:
+            self.reg = self.reg.copy()
+        old = self.reg[reg_index]
+        new = max(old, self._get_rank(bits))
+        self.reg[reg_index] = new
+        if self.hsum is not None and new != old:
+            self.hsum += _inverse_powers[new] - _inverse_powers[old]
+            if old == 0:
+                self.num_zero -= 1
+
+    def _hash_values(self, values, hashfunc):
+        '''
+        Get the hash values of `values`, as in `update_batch`, as a uint64
+        array.
+        '''
+        if isinstance(values, np.ndarray):
+            return values.astype(np.uint64).ravel()
+        digests = b"".join(hashfunc(v).digest()[:self._hash_range_byte]
+                for v in values)
+        return np.frombuffer(digests, dtype=self._hash_dtype).astype(np.uint64)
+
+    def update_batch(self, values, hashfunc=sha1):
+        '''
+        Update this HyperLogLog with many values at once.
+        `values` is either an iterable of bytes, each of which is hashed
+        using `hashfunc` (the digest is truncated to the hash range, same
+        as in `digest`), or a numpy array of hash values: 32-bit for
+        HyperLogLog and 64-bit for HyperLogLogPlusPlus.
+        '''
+        hvs = self._hash_values(values, hashfunc)
+        if hvs.size == 0:
+            return
+        # Get the indexes of the registers using the first p bits of the
+        # hashes, and the ranks using the rest
+        reg_index = (hvs & np.uint64(self.m - 1)).astype(np.intp)
+        ranks = self._get_ranks(hvs >> np.uint64(self.p))
+        # Update the registers, taking the maximum rank for each index,
+        # copying read-only registers first
+        if not self.reg.flags.writeable:
+            self.reg = self.reg.copy()
+        if self.hsum is None:
+            np.maximum.at(self.reg, reg_index, ranks.astype(np.int8))
+            return
+        touched = np.unique(reg_index)
+        old = self.reg[touched]
+        np.maximum.at(self.reg, reg_index, ranks.astype(np.int8))
+        new = self.reg[touched]
+        self.hsum += np.sum(_inverse_powers[new] - _inverse_powers[old])
+        self.num_zero -= np.count_nonzero((old == 0) & (new != 0))
+
+    def _get_reg(self):
+        '''
+        Get the registers.
+        '''
+        return self.reg
 
     def merge(self, other):
         '''
@@ -118,6 +260,8 @@ class HyperLogLog(object):
             raise ValueError("Cannot merge HyperLogLog with different\
                     precisions.")
         self.reg = np.maximum(self.reg, other.reg)
+        if self.hsum is not None:
+            self._reset_sums()
 
     def _linearcounting(self, num_zero):
         return self.m * np.log(self.m / float(num_zero))
@@ -129,18 +273,39 @@ class HyperLogLog(object):
         '''
         Estimate the cardinality of the data seen so far.
         '''
+        hsum, num_zero = self._get_sums()
         # Use HyperLogLog estimation function
-        e = self.alpha * float(self.m ** 2) / np.sum(2.0**(-self.reg))
+        e = self.alpha * float(self.m ** 2) / hsum
         # Small range correction
         if e <= (5.0 / 2.0) * self.m:
-            num_zero = self.m - np.count_nonzero(self.reg)
             return self._linearcounting(num_zero)
         # Normal range, no correction
         if e <= (1.0 / 30.0) * (1 << 32):
             return e
         # Large range correction
         return self._largerange_correction(e)
-    
+
+    @classmethod
+    def count_batch(cls, regs):
+        '''
+        Estimate the cardinalities of many HyperLogLogs of the same precision
+        at once, given their registers as the rows of the 2-dimensional
+        numpy.ndarray `regs`. Returns an array of estimates.
+        '''
+        h = cls(reg=regs[0])
+        m = h.m
+        e = h.alpha * float(m ** 2) / np.sum(_inverse_powers[regs], axis=1)
+        num_zero = m - np.sum(regs != 0, axis=1)
+        # Small range correction, where there are empty registers
+        small = (e <= (5.0 / 2.0) * m) & (num_zero > 0)
+        with np.errstate(divide='ignore'):
+            lc = m * np.log(m / num_zero.astype(np.float64))
+        # Large range correction
+        large = e > (1.0 / 30.0) * (1 << 32)
+        with np.errstate(invalid='ignore'):
+            lr = h._largerange_correction(e)
+        return np.where(small, lc, np.where(large, lr, e))
+
     @classmethod
     def union(cls, *hyperloglogs):
         '''
@@ -189,30 +354,40 @@ class HyperLogLog(object):
         if len(buf) < self.bytesize():
             raise ValueError("The buffer does not have enough space\
                     for holding this HyperLogLog.")
-        fmt = 'B%dB' % self.m
-        struct.pack_into(fmt, buf, 0, self.p, *self.reg)
+        struct.pack_into('B', buf, 0, self.p)
+        offset = struct.calcsize('B')
+        np.frombuffer(buf, dtype=np.int8, count=self.m,
+                offset=offset)[:] = self.reg
 
-    @classmethod
-    def deserialize(cls, buf):
+    @staticmethod
+    def _reg_from_buffer(buf, copy=True):
         '''
-        Reconstruct a HyperLogLog from bytes in `buf`.
-        This is more efficient than using the pickle.loads on the pickled
-        bytes.
+        Get a copy of the registers serialized in `buf`, or a read-only
+        view of them if `copy` is False.
         '''
         size = struct.calcsize('B')
         try:
             p = struct.unpack_from('B', buf, 0)[0]
         except TypeError:
             p = struct.unpack_from('B', buffer(buf), 0)[0]
-        h = cls(p)
-        offset = size
-        try:
-            h.reg = np.array(struct.unpack_from('%dB' % h.m, 
-                buf, offset), dtype=np.int8)
-        except TypeError:
-            h.reg = np.array(struct.unpack_from('%dB' % h.m, 
-                buffer(buf), offset), dtype=np.int8)
-        return h
+        reg = np.frombuffer(buf, dtype=np.int8, count=1 << p, offset=size)
+        if copy:
+            return reg.copy()
+        reg.flags.writeable = False
+        return reg
+
+    @classmethod
+    def deserialize(cls, buf, copy=True):
+        '''
+        Reconstruct a HyperLogLog from bytes in `buf`.
+        This is more efficient than using the pickle.loads on the pickled
+        bytes.
+        If `copy` is False, the registers are a read-only view of `buf`
+        rather than a copy, and are copied only when the HyperLogLog is
+        first updated. `buf` must then not be modified while the
+        HyperLogLog is in use.
+        '''
+        return cls(reg=cls._reg_from_buffer(buf, copy=copy))
 
     def __getstate__(self):
         '''
@@ -232,19 +407,7 @@ class HyperLogLog(object):
         Note that the input buffer is not the same as the input to the
         Python pickle.loads function.
         '''
-        size = struct.calcsize('B')
-        try:
-            p = struct.unpack_from('B', buf, 0)[0]
-        except TypeError:
-            p = struct.unpack_from('B', buffer(buf), 0)[0]
-        self.__init__(p=p)
-        offset = size
-        try:
-            self.reg = np.array(struct.unpack_from('%dB' % self.m, 
-                buf, offset), dtype=np.int8)
-        except TypeError:
-            self.reg = np.array(struct.unpack_from('%dB' % self.m, 
-                buffer(buf), offset), dtype=np.int8)
+        self.__init__(reg=self._reg_from_buffer(buf))
 
 
 class HyperLogLogPlusPlus(HyperLogLog):
@@ -254,32 +417,314 @@ class HyperLogLogPlusPlus(HyperLogLog):
     Main changes:
     1) Use 64 bits instead of 32 bits for hash function
     2) A new small-cardinality estimation scheme
-    3) Sparse representation (not implemented here)
+    3) Sparse representation, enabled with `sparse=True`
     '''
-    
+
+    __slots__ = ('sparse', 'sparse_tmp')
+
     _hash_range_bit = 64
     _hash_range_byte = 8
     _struct_fmt_str = '<Q'
+    _hash_dtype = np.dtype('<u8')
+
+    # The precision of the indexes in the sparse representation
+    _sparse_p = 25
+    # Each sparse entry is an integer (index << 6) | rank, where the rank
+    # is computed on the hash bits above the sparse index
+    _sparse_rank_bits = 6
+    _sparse_max_rank = 64 - 25
+    # The serialized sparse representation: p with the highest bit set
+    # as uint8, and the size of the encoded entries as uint32
+    _sparse_flag = 0x80
+    _sparse_fmt_header = '<BI'
+
+    def __init__(self, p=8, reg=None, sparse=False, incremental=False):
+        '''
+        Create a HyperLogLog++ with precision parameter `p` and (optionally)
+        a register vector `reg`, same as HyperLogLog.
+        If `sparse` is True and `reg` is not specified, the HyperLogLog++
+        starts in the sparse representation: a sorted, delta-encoded list
+        of (index, rank) entries at precision 25, which is converted to
+        registers automatically once it becomes larger than them.
+        The `incremental` mode is the same as in HyperLogLog, and starts
+        once the HyperLogLog++ is converted to registers.
+        '''
+        super(HyperLogLogPlusPlus, self).__init__(p=p, reg=reg,
+                incremental=incremental)
+        self.sparse = None
+        self.sparse_tmp = []
+        if sparse and reg is None:
+            self.reg = None
+            self.sparse = b""
+
+    def is_sparse(self):
+        '''
+        Check if the HyperLogLog++ is in the sparse representation.
+        '''
+        return self.sparse is not None
+
+    def _get_sparse_entries(self, hvs):
+        sparse_index = hvs & np.uint64((1 << self._sparse_p) - 1)
+        ranks = self._sparse_max_rank - \
+                _bit_length_batch(hvs >> np.uint64(self._sparse_p)) + 1
+        return (sparse_index << np.uint64(self._sparse_rank_bits)) | \
+                ranks.astype(np.uint64)
+
+    def _get_sparse(self):
+        '''
+        Merge the insertion buffer into the sparse list, and return the
+        sorted array of entries, with one entry per index.
+        '''
+        entries = np.cumsum(_decode_varints(self.sparse), dtype=np.uint64)
+        if self.sparse_tmp:
+            entries = np.concatenate((entries,
+                np.array(self.sparse_tmp, dtype=np.uint64)))
+            self.sparse_tmp = []
+            entries = self._set_sparse(entries)
+        return entries
+
+    def _flush_sparse(self):
+        '''
+        Merge the insertion buffer into the sparse list, which may convert
+        the sparse representation to registers.
+        '''
+        if self.sparse is not None and self.sparse_tmp:
+            self._get_sparse()
+
+    def _set_sparse(self, entries):
+        '''
+        Store the entries as the sparse list, keeping the maximum rank for
+        each index, or convert to registers if they have grown larger.
+        Returns the stored entries.
+        '''
+        if entries.size == 0:
+            self.sparse = b""
+            return entries
+        entries = np.sort(entries)
+        # Sorting by entry sorts by index and then by rank, so keep the
+        # last entry of each index
+        index = entries >> np.uint64(self._sparse_rank_bits)
+        entries = entries[np.append(index[1:] != index[:-1], True)]
+        self.sparse = _encode_varints(np.diff(np.concatenate((
+            np.zeros((1,), dtype=np.uint64), entries))))
+        if len(self.sparse) > self.m:
+            self._to_dense(entries)
+        return entries
+
+    def _sparse_to_reg(self, entries):
+        '''
+        Compute the registers from the sparse entries.
+        '''
+        sparse_index = entries >> np.uint64(self._sparse_rank_bits)
+        ranks = (entries & np.uint64((1 << self._sparse_rank_bits) - 1))\
+                .astype(np.int64)
+        # When all the bits above the sparse index are zero, the rank is
+        # given by the bits of the sparse index above the first p bits
+        low = ranks == self._sparse_max_rank + 1
+        ranks[low] = self.max_rank - _bit_length_batch(
+                sparse_index[low] >> np.uint64(self.p)) + 1
+        reg = np.zeros((self.m,), dtype=np.int8)
+        reg_index = (sparse_index & np.uint64(self.m - 1)).astype(np.intp)
+        np.maximum.at(reg, reg_index, ranks.astype(np.int8))
+        return reg
+
+    def _to_dense(self, entries=None):
+        '''
+        Convert the sparse representation to registers.
+        '''
+        if self.sparse is None:
+            return
+        if entries is None:
+            entries = self._get_sparse()
+        self.reg = self._sparse_to_reg(entries)
+        self.sparse = None
+        self.sparse_tmp = []
+        if self.hsum is not None:
+            self._reset_sums()
+
+    def _get_reg(self):
+        '''
+        Get the registers, computed from the sparse entries if sparse.
+        '''
+        if self.sparse is None:
+            return self.reg
+        return self._sparse_to_reg(self._get_sparse())
+
+    def is_empty(self):
+        if self.sparse is not None:
+            return not self.sparse and not self.sparse_tmp
+        return super(HyperLogLogPlusPlus, self).is_empty()
+
+    def digest(self, hashobj):
+        if self.sparse is None:
+            return super(HyperLogLogPlusPlus, self).digest(hashobj)
+        hv = struct.unpack(self._struct_fmt_str,
+                hashobj.digest()[:self._hash_range_byte])[0]
+        sparse_index = hv & ((1 << self._sparse_p) - 1)
+        rank = self._sparse_max_rank - _bit_length(hv >> self._sparse_p) + 1
+        self.sparse_tmp.append((sparse_index << self._sparse_rank_bits) | rank)
+        # Merge the insertion buffer when it has grown to a quarter
+        # of the size of the registers
+        if len(self.sparse_tmp) * 4 >= self.m:
+            self._get_sparse()
+
+    def update_batch(self, values, hashfunc=sha1):
+        if self.sparse is None:
+            return super(HyperLogLogPlusPlus, self).update_batch(values,
+                    hashfunc)
+        hvs = self._hash_values(values, hashfunc)
+        if hvs.size == 0:
+            return
+        entries = self._get_sparse()
+        self._set_sparse(np.concatenate((entries,
+            self._get_sparse_entries(hvs))))
+
+    def merge(self, other):
+        if self.m != other.m or self.p != other.p:
+            raise ValueError("Cannot merge HyperLogLog with different\
+                    precisions.")
+        if self.sparse is not None and other.sparse is not None:
+            self._set_sparse(np.concatenate((self._get_sparse(),
+                other._get_sparse())))
+            return
+        self._to_dense()
+        self.reg = np.maximum(self.reg, other._get_reg())
+        if self.hsum is not None:
+            self._reset_sums()
+
+    @classmethod
+    def union(cls, *hyperloglogs):
+        if len(hyperloglogs) < 2:
+            raise ValueError("Cannot union less than 2 HyperLogLog\
+                    sketches")
+        m = hyperloglogs[0].m
+        if not all(h.m == m for h in hyperloglogs):
+            raise ValueError("Cannot union HyperLogLog sketches with\
+                    different precisions")
+        if all(h.sparse is not None for h in hyperloglogs):
+            h = cls(p=hyperloglogs[0].p, sparse=True)
+            h._set_sparse(np.concatenate([x._get_sparse()
+                for x in hyperloglogs]))
+            return h
+        reg = np.maximum.reduce([h._get_reg() for h in hyperloglogs])
+        return cls(reg=reg)
+
+    def __eq__(self, other):
+        if self.p != other.p or self.m != other.m:
+            return False
+        self._flush_sparse()
+        other._flush_sparse()
+        if self.sparse is not None and other.sparse is not None:
+            return np.array_equal(self._get_sparse(), other._get_sparse())
+        if self.sparse is not None or other.sparse is not None:
+            return False
+        return super(HyperLogLogPlusPlus, self).__eq__(other)
+
+    def bytesize(self):
+        self._flush_sparse()
+        if self.sparse is None:
+            return super(HyperLogLogPlusPlus, self).bytesize()
+        return struct.calcsize(self._sparse_fmt_header) + len(self.sparse)
+
+    def serialize(self, buf):
+        self._flush_sparse()
+        if self.sparse is None:
+            return super(HyperLogLogPlusPlus, self).serialize(buf)
+        if len(buf) < self.bytesize():
+            raise ValueError("The buffer does not have enough space\
+                    for holding this HyperLogLog.")
+        struct.pack_into(self._sparse_fmt_header, buf, 0,
+                self.p | self._sparse_flag, len(self.sparse))
+        offset = struct.calcsize(self._sparse_fmt_header)
+        buf[offset:offset+len(self.sparse)] = self.sparse
+
+    def _set_serialized_sparse(self, buf):
+        '''
+        Read the sparse representation serialized in `buf`, if it is.
+        Returns True if the sparse representation was read.
+        '''
+        try:
+            flagged_p, size = struct.unpack_from(self._sparse_fmt_header,
+                    buf, 0)
+        except TypeError:
+            flagged_p, size = struct.unpack_from(self._sparse_fmt_header,
+                    buffer(buf), 0)
+        except struct.error:
+            # Too short for the sparse header
+            return False
+        if not flagged_p & self._sparse_flag:
+            return False
+        self.__init__(p=flagged_p & ~self._sparse_flag, sparse=True)
+        offset = struct.calcsize(self._sparse_fmt_header)
+        self.sparse = bytes(buf[offset:offset+size])
+        return True
+
+    @classmethod
+    def deserialize(cls, buf, copy=True):
+        h = cls.__new__(cls)
+        if h._set_serialized_sparse(buf):
+            return h
+        return super(HyperLogLogPlusPlus, cls).deserialize(buf, copy=copy)
+
+    def __setstate__(self, buf):
+        if not self._set_serialized_sparse(buf):
+            super(HyperLogLogPlusPlus, self).__setstate__(buf)
 
     def _get_threshold(self, p):
         return _thresholds[p - 4]
 
     def _estimate_bias(self, e, p):
+        return self._estimate_bias_batch(np.array([e]), p)[0]
+
+    @staticmethod
+    def _estimate_bias_batch(e, p):
+        '''
+        Estimate the biases of the array of raw estimates `e`, using the
+        mean bias of the 6 nearest raw estimates in the table.
+        '''
         bias_vector = _bias[p - 4]
         estimate_vector = _raw_estimate[p - 4]
-        nearest_neighbors = np.argsort((e - estimate_vector)**2)[:6]
-        return np.mean(bias_vector[nearest_neighbors])
+        # Binary search the sorted table, then take the nearest neighbors
+        # from a fixed window around the position found
+        start = np.clip(np.searchsorted(estimate_vector, e) - _bias_window,
+                0, len(estimate_vector) - 2 * _bias_window)
+        window = start[:, np.newaxis] + np.arange(2 * _bias_window)
+        nearest = np.argsort((e[:, np.newaxis] - estimate_vector[window])**2,
+                axis=1)[:, :6]
+        nearest_neighbors = window[np.arange(len(e))[:, np.newaxis], nearest]
+        return np.mean(bias_vector[nearest_neighbors], axis=1)
 
     def count(self):
-        num_zero = self.m - np.count_nonzero(self.reg)
+        self._flush_sparse()
+        if self.sparse is not None:
+            # Linear counting at the sparse precision
+            num_entries = len(self._get_sparse())
+            sparse_m = 1 << self._sparse_p
+            return sparse_m * np.log(sparse_m / float(sparse_m - num_entries))
+        hsum, num_zero = self._get_sums()
         if num_zero > 0:
             # linear counting
             lc = self._linearcounting(num_zero)
             if lc <= self._get_threshold(self.p):
                 return lc
         # Use HyperLogLog estimation function
-        e = self.alpha * float(self.m ** 2) / np.sum(2.0**(-self.reg))
+        e = self.alpha * float(self.m ** 2) / hsum
         if e <= 5 * self.m:
             return e - self._estimate_bias(e, self.p)
         else:
             return e
+
+    @classmethod
+    def count_batch(cls, regs):
+        h = cls(reg=regs[0])
+        m = h.m
+        num_zero = m - np.sum(regs != 0, axis=1)
+        # Linear counting, where there are empty registers
+        with np.errstate(divide='ignore'):
+            lc = m * np.log(m / num_zero.astype(np.float64))
+        use_lc = (num_zero > 0) & (lc <= h._get_threshold(h.p))
+        # Use HyperLogLog estimation function
+        e = h.alpha * float(m ** 2) / np.sum(_inverse_powers[regs], axis=1)
+        biased = e <= 5 * m
+        e[biased] -= h._estimate_bias_batch(e[biased], h.p)
+        return np.where(use_lc, lc, e)
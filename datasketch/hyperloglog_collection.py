@@ -0,0 +1,278 @@
+'''
+This module implements HLLCollection - a collection of HyperLogLog
+sketches of the same precision stored as one (number of sketches x m)
+register matrix, so that many sketches are merged, unioned and counted
+with vectorized operations instead of one HyperLogLog at a time.
+'''
+
+import struct
+import numpy as np
+try:
+    from .hyperloglog import HyperLogLog, HyperLogLogPlusPlus
+    from ._storage import _reserve_rows
+except ImportError:
+    # For Python 2
+    from hyperloglog import HyperLogLog, HyperLogLogPlusPlus
+    from _storage import _reserve_rows
+
+
+class HLLCollection(object):
+    '''
+    The HLLCollection object, holding many HyperLogLog (or HyperLogLog++)
+    sketches with the same precision.
+    '''
+
+    __slots__ = ('hll_class', '_regs', '_size', '_union_counts')
+
+    # The maximum number of registers in the temporary arrays used for
+    # computing the pairwise unions
+    _batch_max_regs = 1 << 22
+
+    # The classes of sketches that can be stored, by their serialized id
+    _hll_classes = (HyperLogLog, HyperLogLogPlusPlus)
+    # p as uint8
+    # sketch class id as uint8
+    # number of sketches as int64
+    _serial_fmt_header = '<BBq'
+
+    def __init__(self, p=8, regs=None, hll_class=HyperLogLog):
+        '''
+        Create an empty collection of sketches of the class `hll_class`
+        with precision parameter `p`.
+        If `regs` is specified, it must be a 2-dimensional numpy.ndarray
+        with the registers of one sketch in each row, which will be used
+        as the underlying matrix, and the `p` parameter value is ignored.
+        '''
+        if hll_class not in self._hll_classes:
+            raise ValueError("hll_class must be HyperLogLog or\
+                    HyperLogLogPlusPlus")
+        if regs is None:
+            if not (4 <= p <= 16):
+                raise ValueError("p=%d should be in range [4 : 16]" % p)
+            regs = np.zeros((0, 1 << p), dtype=np.int8)
+        else:
+            if not isinstance(regs, np.ndarray) or regs.ndim != 2:
+                raise ValueError("The imported registers must be a\
+                        2-dimensional numpy.ndarray.")
+            m = regs.shape[1]
+            if m & (m - 1) != 0:
+                raise ValueError("The imported registers have incorrect\
+                        size. Expect a power of 2.")
+        self.hll_class = hll_class
+        self._regs = regs
+        self._size = regs.shape[0]
+        # The cached pairwise union cardinalities, reset when the
+        # collection changes
+        self._union_counts = None
+
+    @classmethod
+    def from_hyperloglogs(cls, hyperloglogs):
+        '''
+        Create a collection from a non-empty list of sketches of the same
+        class and precision.
+        '''
+        if len(hyperloglogs) == 0:
+            raise ValueError("Cannot create a collection from an empty list")
+        hll_class = type(hyperloglogs[0])
+        m = hyperloglogs[0].m
+        if not all(type(h) is hll_class and h.m == m for h in hyperloglogs):
+            raise ValueError("The sketches must have the same class and\
+                    precision")
+        regs = np.vstack([h._get_reg() for h in hyperloglogs])
+        return cls(regs=regs, hll_class=hll_class)
+
+    @property
+    def regs(self):
+        '''
+        The (number of sketches x m) matrix of registers, as a read-only
+        view, so that the collection only changes through its methods.
+        '''
+        regs = self._regs[:self._size]
+        regs.flags.writeable = False
+        return regs
+
+    @property
+    def m(self):
+        return self._regs.shape[1]
+
+    @property
+    def p(self):
+        return self.m.bit_length() - 1
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        '''
+        Get the i-th sketch. Its registers are a read-only view of the row
+        in this collection, which the sketch copies when it is updated, so
+        updating the sketch does not change the collection.
+        '''
+        if not -self._size <= i < self._size:
+            raise IndexError("HLLCollection index out of range")
+        return self.hll_class(reg=self.regs[i])
+
+    def _reserve(self, n):
+        '''
+        Make room for `n` more sketches and return the index of the
+        first one.
+        '''
+        start = self._size
+        self._regs = _reserve_rows(self._regs, start, n)
+        self._size += n
+        self._union_counts = None
+        return start
+
+    def add(self, hyperloglog):
+        '''
+        Append a copy of the registers of `hyperloglog` to the collection,
+        and return its index.
+        '''
+        if type(hyperloglog) is not self.hll_class or \
+                hyperloglog.m != self.m:
+            raise ValueError("The sketch must have the same class and\
+                    precision as the collection")
+        i = self._reserve(1)
+        self._regs[i] = hyperloglog._get_reg()
+        return i
+
+    def count(self):
+        '''
+        Estimate the cardinalities of all sketches.
+        '''
+        if self._size == 0:
+            return np.zeros((0,), dtype=np.float64)
+        return self.hll_class.count_batch(self.regs)
+
+    def merge(self, other):
+        '''
+        Merge every sketch of the collection `other` into the sketch with
+        the same index in this collection.
+        '''
+        if other.hll_class is not self.hll_class or other.m != self.m or \
+                len(other) != len(self):
+            raise ValueError("Cannot merge collections with different\
+                    classes, precisions or numbers of sketches")
+        self._regs = np.maximum(self.regs, other.regs)
+        self._union_counts = None
+
+    def union_all(self):
+        '''
+        Return the union of all sketches as one sketch.
+        '''
+        if self._size == 0:
+            return self.hll_class(p=self.p)
+        return self.hll_class(reg=np.max(self.regs, axis=0))
+
+    def union(self, groups):
+        '''
+        Union the sketches by group: `groups` is an array with the group key
+        of every sketch. Returns the sorted array of distinct group keys, and
+        a collection with the union of each group in the same order.
+        '''
+        groups = np.asarray(groups)
+        if groups.shape != (self._size,):
+            raise ValueError("Expect one group key for every sketch")
+        order = np.argsort(groups, kind='mergesort')
+        keys, starts = np.unique(groups[order], return_index=True)
+        if self._size == 0:
+            return keys, HLLCollection(p=self.p, hll_class=self.hll_class)
+        regs = np.maximum.reduceat(self.regs[order], starts, axis=0)
+        return keys, HLLCollection(regs=regs, hll_class=self.hll_class)
+
+    def window_union(self, width):
+        '''
+        Union every `width` consecutive sketches: the i-th sketch in the
+        returned collection is the union of sketches i to i + width - 1.
+        '''
+        if not 1 <= width <= self._size:
+            raise ValueError("width must be in [1, number of sketches]")
+        # Double the span of the unions until the next doubling would be
+        # wider than the window, then cover the window with two of them
+        regs = self.regs
+        span = 1
+        while span * 2 <= width:
+            regs = np.maximum(regs[:-span], regs[span:])
+            span *= 2
+        n = self._size - width + 1
+        regs = np.maximum(regs[:n], regs[width-span:width-span+n])
+        return HLLCollection(regs=regs, hll_class=self.hll_class)
+
+    def union_count_matrix(self):
+        '''
+        Estimate the cardinalities of the unions of all pairs of sketches.
+        Returns a symmetric (number of sketches x number of sketches)
+        matrix, which is cached until the collection is changed through
+        `add` or `merge`.
+        '''
+        if self._union_counts is not None:
+            return self._union_counts
+        regs = self.regs
+        n = self._size
+        counts = np.empty((n, n), dtype=np.float64)
+        block_size = max(1, int(np.sqrt(self._batch_max_regs // self.m)))
+        for i in range(0, n, block_size):
+            r1 = regs[i:i+block_size, np.newaxis, :]
+            # The matrix is symmetric, so only compute the upper blocks
+            for j in range(i, n, block_size):
+                r2 = regs[np.newaxis, j:j+block_size, :]
+                unions = np.maximum(r1, r2)
+                c = self.hll_class.count_batch(unions.reshape(-1, self.m))\
+                        .reshape(unions.shape[:2])
+                counts[i:i+block_size, j:j+block_size] = c
+                counts[j:j+block_size, i:i+block_size] = c.T
+        self._union_counts = counts
+        return counts
+
+    def intersection_matrix(self):
+        '''
+        Estimate the cardinalities of the intersections of all pairs of
+        sketches, by inclusion-exclusion: |A & B| = |A| + |B| - |A | B|.
+        Negative estimates are clipped to zero.
+        '''
+        unions = self.union_count_matrix()
+        counts = np.diag(unions)
+        intersections = counts[:, np.newaxis] + counts[np.newaxis, :] - unions
+        return np.maximum(intersections, 0.0)
+
+    def jaccard_matrix(self):
+        '''
+        Estimate the Jaccard similarities of all pairs of sketches, as the
+        ratio of the intersection and union cardinality estimates.
+        The similarity is zero where the union is empty.
+        '''
+        unions = self.union_count_matrix()
+        intersections = self.intersection_matrix()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(unions > 0, intersections / unions, 0.0)
+
+    def save(self, path):
+        '''
+        Save this collection to the file `path`: a header with the precision,
+        the class of the sketches and the number of sketches, followed by
+        the registers as one contiguous block of bytes.
+        '''
+        with open(path, 'wb') as f:
+            f.write(struct.pack(self._serial_fmt_header, self.p,
+                self._hll_classes.index(self.hll_class), len(self)))
+            np.ascontiguousarray(self.regs).tofile(f)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        '''
+        Load a collection saved in the file `path`. If `mmap` is True,
+        the file is memory-mapped read-only instead of being read, and the
+        sketches returned by indexing are views of the file that are
+        copied only when updated.
+        '''
+        header_size = struct.calcsize(cls._serial_fmt_header)
+        with open(path, 'rb') as f:
+            p, class_id, size = struct.unpack(cls._serial_fmt_header,
+                    f.read(header_size))
+            if mmap:
+                regs = np.memmap(f, dtype=np.int8, mode='r',
+                        offset=header_size, shape=(size, 1 << p))
+            else:
+                regs = np.fromfile(f, dtype=np.int8, count=size << p)
+        return cls(regs=regs.reshape(size, 1 << p),
+                hll_class=cls._hll_classes[class_id])
@@ -7,40 +7,95 @@ Reference: Chapter 3, Mining of Massive Datasets
 (http://www.mmds.org/)
 '''
 
+import os
+import pickle
+import numpy as np
 try:
-    from .minhash import MinHash
+    from .minhash import MinHash, _batch_max_elements, _mix64
+    from ._storage import _reserve_rows, _check_signature_matrix, \
+            _add_keys
+    from .weighted_minhash import WeightedMinHash
 except ImportError:
     # For Python 2
-    from minhash import MinHash
+    from minhash import MinHash, _batch_max_elements, _mix64
+    from _storage import _reserve_rows, _check_signature_matrix, \
+            _add_keys
+    from weighted_minhash import WeightedMinHash
 
 
-_integration_precision = 0.001
-def _integration(f, a, b):
-    p = _integration_precision
-    area = 0.0
-    x = a
-    while x < b:
-        area += f(x+0.5*p)*p
-        x += p
-    return area, None
+# The (b, r) matrices of multipliers of the band keys, by (b, r)
+_band_multipliers = dict()
 
-try:
-    from scipy.integrate import quad as integrate
-except ImportError:
-    # For when no scipy installed
-    integrate = _integration
+
+def _band_keys(hashvalues, b, r):
+    '''
+    Compute the keys of the `b` bands of `r` hash values each, for the
+    hash values along the last axis of `hashvalues`, as uint64 integers.
+    Every hash value is multiplied by a random odd constant specific to its
+    position and the products in a band are summed modulo 2^64 and mixed,
+    so that the keys of different bands are independent.
+    '''
+    if (b, r) not in _band_multipliers:
+        multipliers = _mix64(np.arange(1, b*r+1, dtype=np.uint64)) | \
+                np.uint64(1)
+        _band_multipliers[(b, r)] = multipliers.reshape(b, r)
+    hv = np.asarray(hashvalues)[..., :b*r].astype(np.uint64)
+    hv = hv.reshape(hv.shape[:-1] + (b, r))
+    hv *= _band_multipliers[(b, r)]
+    return _mix64(hv.sum(axis=-1, dtype=np.uint64))
 
 
-def _false_positive_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - s**float(r))**float(b)
-    a, err = integrate(_probability, 0.0, threshold) 
-    return a
+# The Gauss-Legendre points and weights by number of points, memoized as
+# they are reused for every chunk of (b, r) pairs
+_legendre_quadratures = dict()
+
+
+def _integrate_polynomial(f, a, b, degree):
+    '''
+    Integrate the polynomial function `f` of degree at most `degree` over
+    [a, b], exactly up to rounding, with Gauss-Legendre quadrature.
+    `f` is evaluated on the array of quadrature points along the last axis.
+    '''
+    n = degree // 2 + 1
+    if n not in _legendre_quadratures:
+        _legendre_quadratures[n] = np.polynomial.legendre.leggauss(n)
+    x, w = _legendre_quadratures[n]
+    x = 0.5 * (b - a) * x + 0.5 * (b + a)
+    return 0.5 * (b - a) * np.sum(w * f(x), axis=-1)
 
 
-def _false_negative_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - (1 - s**float(r))**float(b))
-    a, err = integrate(_probability, threshold, 1.0)
-    return a
+def _false_positive_probability(threshold, b, r, degree=None):
+    b = np.asarray(b, dtype=np.float64)[..., np.newaxis]
+    r = np.asarray(r, dtype=np.float64)[..., np.newaxis]
+    _probability = lambda s : 1 - (1 - s**r)**b
+    if degree is None:
+        degree = int(np.max(b * r))
+    return _integrate_polynomial(_probability, 0.0, threshold, degree)
+
+
+def _false_negative_probability(threshold, b, r, degree=None):
+    b = np.asarray(b, dtype=np.float64)[..., np.newaxis]
+    r = np.asarray(r, dtype=np.float64)[..., np.newaxis]
+    _probability = lambda s : 1 - (1 - (1 - s**r)**b)
+    if degree is None:
+        degree = int(np.max(b * r))
+    return _integrate_polynomial(_probability, threshold, 1.0, degree)
+
+
+# The optimal parameters by (threshold, num_perm, false_positive_weight,
+# false_negative_weight), precomputed for common configurations and
+# extended as new ones are optimized
+_optimal_params = {
+    (0.1, 64, 0.5, 0.5): (15, 1), (0.2, 64, 0.5, 0.5): (28, 2), (0.3, 64, 0.5, 0.5): (21, 3),
+    (0.4, 64, 0.5, 0.5): (16, 4), (0.5, 64, 0.5, 0.5): (14, 4), (0.6, 64, 0.5, 0.5): (10, 6),
+    (0.7, 64, 0.5, 0.5): (8, 8), (0.8, 64, 0.5, 0.5): (5, 11), (0.9, 64, 0.5, 0.5): (3, 21),
+    (0.1, 128, 0.5, 0.5): (64, 2), (0.2, 128, 0.5, 0.5): (28, 2), (0.3, 128, 0.5, 0.5): (37, 3),
+    (0.4, 128, 0.5, 0.5): (32, 4), (0.5, 128, 0.5, 0.5): (25, 5), (0.6, 128, 0.5, 0.5): (18, 7),
+    (0.7, 128, 0.5, 0.5): (14, 9), (0.8, 128, 0.5, 0.5): (9, 13), (0.9, 128, 0.5, 0.5): (5, 25),
+    (0.1, 256, 0.5, 0.5): (117, 2), (0.2, 256, 0.5, 0.5): (85, 3), (0.3, 256, 0.5, 0.5): (64, 4),
+    (0.4, 256, 0.5, 0.5): (51, 5), (0.5, 256, 0.5, 0.5): (42, 6), (0.6, 256, 0.5, 0.5): (32, 8),
+    (0.7, 256, 0.5, 0.5): (25, 10), (0.8, 256, 0.5, 0.5): (17, 15), (0.9, 256, 0.5, 0.5): (9, 28),
+}
 
 
 def _optimal_param(threshold, num_perm, false_positive_weight,
@@ -48,19 +103,34 @@ def _optimal_param(threshold, num_perm, false_positive_weight,
     '''
     Compute the optimal LSH parameter that minimizes the weighted sum
     of probabilities of false positive and false negative.
+    The probabilities are computed for chunks of (b, r) pairs at a time,
+    bounding the size of the (pairs x quadrature points) temporary arrays,
+    and the result is memoized.
     '''
-    min_error = float("inf")
-    opt = (0, 0)
-    for b in range(1, num_perm+1):
-        max_r = int(num_perm / b)
-        for r in range(1, max_r+1):
-            fp = _false_positive_probability(threshold, b, r)
-            fn = _false_negative_probability(threshold, b, r)
-            error = fp*false_positive_weight + fn*false_negative_weight
-            if error < min_error:
-                min_error = error
-                opt = (b, r)
-    return opt
+    key = (threshold, num_perm, false_positive_weight, false_negative_weight)
+    if key not in _optimal_params:
+        bs = np.arange(1, num_perm+1)
+        max_rs = num_perm // bs
+        # All pairs with b * r <= num_perm, ordered by b then r
+        b = np.repeat(bs, max_rs)
+        r = np.arange(len(b)) - np.repeat(np.cumsum(max_rs) - max_rs,
+                max_rs) + 1
+        # The same quadrature is used for all chunks, exact for the
+        # highest degree of all pairs
+        degree = int(np.max(b * r))
+        error = np.empty(len(b), dtype=np.float64)
+        chunk_size = max(1, _batch_max_elements // (degree // 2 + 1))
+        for start in range(0, len(b), chunk_size):
+            end = start + chunk_size
+            fp = _false_positive_probability(threshold, b[start:end],
+                    r[start:end], degree)
+            fn = _false_negative_probability(threshold, b[start:end],
+                    r[start:end], degree)
+            error[start:end] = fp*false_positive_weight + \
+                    fn*false_negative_weight
+        i = np.argmin(error)
+        _optimal_params[key] = (int(b[i]), int(r[i]))
+    return _optimal_params[key]
 
 
 class LSH(object):
@@ -92,50 +162,414 @@ class LSH(object):
             raise ValueError("Weights must sum to 1.0")
         self.threshold = threshold
         self.num_perm = num_perm
+        self.weights = weights
         false_positive_weight, false_negative_weight = weights
         self.b, self.r = _optimal_param(threshold, num_perm,
                 false_positive_weight, false_negative_weight)
-        self.hashtables = [dict() for _ in range(self.b)]
         self.hashranges = [(i*self.r, (i+1)*self.r) for i in range(self.b)]
+        # The keys are numbered in the order of insertion, and the index
+        # stores the ids instead of the keys. The ids of removed keys are
+        # flagged, and their entries in _keys are None, until the index is
+        # compacted.
+        self._keys = []
+        self._ids = dict()
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._removed = np.zeros((0,), dtype=np.bool_)
+        # The buckets of the keys inserted one at a time, mapping every
+        # band key to the list of ids in each band
+        self.hashtables = [dict() for _ in range(self.b)]
+        # The buckets of the bulk-inserted keys, as sorted unique band keys
+        # and the ids of each bucket in
+        # _bucket_ids[_bucket_offsets[i]:_bucket_offsets[i+1]]
+        self._bucket_keys = np.empty((0,), dtype=np.uint64)
+        self._bucket_offsets = np.zeros((1,), dtype=np.int64)
+        self._bucket_ids = np.empty((0,), dtype=np.int64)
+
+    # The index is compacted when the removed keys are more than this
+    # fraction of all ids
+    _max_removed_fraction = 0.5
+
+    # The arrays of a snapshot, saved to <name>.npy files
+    _snapshot_arrays = ('_signatures', '_bucket_keys', '_bucket_offsets',
+            '_bucket_ids')
+    # The version of the snapshot format, saved in index.pickle
+    _snapshot_version = 1
 
     def is_empty(self):
-        return any(len(t) == 0 for t in self.hashtables)
+        return len(self._ids) == 0
 
-    def _H(self, hs):
-        return "".join("%.8x" % h for h in hs)
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def _H(self, hashvalues):
+        '''
+        Get the keys of all bands of the hash values as Python integers.
+        '''
+        return _band_keys(hashvalues, self.b, self.r).tolist()
+
+    def _check(self, minhash):
+        '''
+        Get the hash values of a MinHash, or the digest of a
+        WeightedMinHash.
+        '''
+        if isinstance(minhash, WeightedMinHash):
+            hashvalues = minhash.digest()
+        elif isinstance(minhash, MinHash):
+            hashvalues = minhash.hashvalues
+        else:
+            raise ValueError("minhash must be of MinHash or WeightedMinHash class")
+        if len(hashvalues) != self.num_perm:
+            raise ValueError("Expecting minhash with %d permutation functions, got %d"
+                    % (self.num_perm, len(hashvalues)))
+        return hashvalues
+
+    def _reserve(self, n):
+        '''
+        Make room for the signatures of `n` more keys and return the id of
+        the first one.
+        '''
+        start = len(self._keys)
+        self._signatures = _reserve_rows(self._signatures, start, n)
+        self._removed = _reserve_rows(self._removed, start, n)
+        return start
+
+    def _band_keys_batch(self, signature_matrix):
+        '''
+        Compute the (number of signatures x b) matrix of band keys, in chunks
+        to bound the size of the temporary arrays.
+        '''
+        result = np.empty((len(signature_matrix), self.b), dtype=np.uint64)
+        chunk_size = max(1, _batch_max_elements // self.num_perm)
+        for start in range(0, len(signature_matrix), chunk_size):
+            result[start:start+chunk_size] = _band_keys(
+                    signature_matrix[start:start+chunk_size], self.b, self.r)
+        return result
 
     def insert(self, key, minhash):
         '''
         Insert a `key` to the index, together
         with a `minhash` of the data referenced by the `key`.
+        `minhash` can also be a WeightedMinHash with num_perm samples.
         '''
-        if not isinstance(minhash, MinHash):
-            raise ValueError("minhash must be of MinHash class")
-        if len(minhash.hashvalues) != self.num_perm:
-            raise ValueError("Expecting minhash with %d permutation functions, got %d"
-                    % (self.num_perm, len(minhash.hashvalues)))
-        for (start, end), hashtable in zip(self.hashranges, self.hashtables):
-            H = self._H(minhash.hashvalues[start:end])
+        hashvalues = self._check(minhash)
+        if key in self._ids:
+            raise ValueError("The given key already exists")
+        i = self._reserve(1)
+        self._signatures[i] = hashvalues
+        self._keys.append(key)
+        self._ids[key] = i
+        for H, hashtable in zip(self._H(hashvalues), self.hashtables):
             if H not in hashtable:
                 hashtable[H] = []
-            hashtable[H].append(key)
+            hashtable[H].append(i)
+
+    def bulk_insert(self, keys, signature_matrix):
+        '''
+        Insert many `keys` to the index at once, together with their
+        MinHash signatures in `signature_matrix`: a MinHashBatch or a
+        (number of keys x num_perm) array with one signature in each row.
+        The band keys of all signatures are computed together and grouped
+        by sorting into compact bucket arrays, which also absorb the keys
+        inserted one at a time so far. Every call re-sorts the buckets of
+        the whole index, so it is best used with large batches.
+        '''
+        keys = list(keys)
+        signature_matrix = _check_signature_matrix(signature_matrix,
+                self.num_perm)
+        if len(keys) != len(signature_matrix):
+            raise ValueError("Expecting one signature for every key")
+        start = self._reserve(len(keys))
+        _add_keys(self._keys, self._ids, keys)
+        self._signatures[start:start+len(keys)] = signature_matrix
+        self._merge_buckets(np.arange(start, len(self._keys), dtype=np.int64))
+
+    def _merge_buckets(self, ids):
+        '''
+        Merge the keys in the hash tables and the keys `ids` into the
+        sorted bucket arrays, dropping the removed keys from the buckets.
+        '''
+        pending = set()
+        for hashtable in self.hashtables:
+            for bucket in hashtable.values():
+                pending.update(bucket)
+            hashtable.clear()
+        ids = np.concatenate([np.fromiter(pending, dtype=np.int64,
+            count=len(pending)), ids])
+        band_keys = self._band_keys_batch(self._signatures[ids]).ravel()
+        bucket_sizes = np.diff(self._bucket_offsets)
+        band_keys = np.concatenate([
+            np.repeat(self._bucket_keys, bucket_sizes), band_keys])
+        ids = np.concatenate([self._bucket_ids, np.repeat(ids, self.b)])
+        live = ~self._removed[ids]
+        band_keys, ids = band_keys[live], ids[live]
+        order = np.argsort(band_keys)
+        band_keys = band_keys[order]
+        # The band keys are sorted, so every bucket starts where the key
+        # changes
+        changes = np.ones(len(band_keys), dtype=np.bool_)
+        changes[1:] = band_keys[1:] != band_keys[:-1]
+        starts = np.flatnonzero(changes)
+        self._bucket_keys = band_keys[starts]
+        self._bucket_offsets = np.append(starts,
+                len(band_keys)).astype(np.int64)
+        self._bucket_ids = ids[order]
+
+    def remove(self, key):
+        '''
+        Remove the `key` from the index. The band keys of the key are
+        recomputed from its stored signature to remove it from the hash
+        tables. In the sorted bucket arrays it is only flagged as removed
+        and skipped by queries, and its id and signature are reclaimed when
+        the index is compacted: by `compact` or `save`, or automatically
+        once the removed keys are more than half of all ids.
+        '''
+        if key not in self._ids:
+            raise ValueError("The given key does not exist")
+        i = self._ids.pop(key)
+        self._removed[i] = True
+        self._keys[i] = None
+        for H, hashtable in zip(self._H(self._signatures[i]), self.hashtables):
+            bucket = hashtable.get(H)
+            if bucket is not None and i in bucket:
+                bucket.remove(i)
+                if len(bucket) == 0:
+                    del hashtable[H]
+        if len(self._keys) - len(self._ids) > \
+                self._max_removed_fraction * len(self._keys):
+            self.compact()
+
+    def update(self, key, minhash):
+        '''
+        Replace the MinHash of the `key` in the index with `minhash`, or
+        insert the `key` if it is not in the index.
+        '''
+        self._check(minhash)
+        if key in self._ids:
+            self.remove(key)
+        self.insert(key, minhash)
+
+    def compact(self):
+        '''
+        Merge all keys into the sorted bucket arrays and renumber them
+        without the removed keys, reclaiming the memory of their ids and
+        signatures. The arrays of an index loaded with `mmap` are read
+        into memory.
+        '''
+        self._merge_buckets(np.empty((0,), dtype=np.int64))
+        live = np.flatnonzero(~self._removed[:len(self._keys)])
+        new_ids = np.zeros((len(self._keys),), dtype=np.int64)
+        new_ids[live] = np.arange(len(live))
+        self._bucket_ids = new_ids[self._bucket_ids]
+        self._signatures = self._signatures[live]
+        self._removed = np.zeros((len(live),), dtype=np.bool_)
+        self._keys = [self._keys[i] for i in live]
+        self._ids = dict(zip(self._keys, range(len(self._keys))))
+
+    def save(self, path):
+        '''
+        Save a snapshot of the index to the directory `path`, created if it
+        does not exist. The index is first compacted, then the signatures
+        and the sorted bucket arrays are saved as .npy files, and the
+        parameters, including the numbers of bands and rows, and keys are
+        pickled together with the version of the format.
+        '''
+        self.compact()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self._snapshot_arrays:
+            np.save(os.path.join(path, name.lstrip('_') + '.npy'),
+                    getattr(self, name))
+        params = {'version': self._snapshot_version,
+                'threshold': self.threshold, 'num_perm': self.num_perm,
+                'weights': self.weights, 'b': self.b, 'r': self.r,
+                'keys': self._keys}
+        with open(os.path.join(path, 'index.pickle'), 'wb') as f:
+            pickle.dump(params, f, protocol=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load a snapshot of an index saved in the directory `path`. If `mmap`
+        is True, the arrays are memory-mapped read-only instead of being
+        read, so the index is ready to query without reading all of them.
+        Inserting keys into the loaded index first copies the signatures
+        into memory. Raises ValueError if the snapshot has another format
+        version, or if its numbers of bands and rows differ from those
+        chosen for its parameters, as the buckets would not match.
+        '''
+        with open(os.path.join(path, 'index.pickle'), 'rb') as f:
+            params = pickle.load(f)
+        if params.get('version') != cls._snapshot_version:
+            raise ValueError("Unsupported snapshot format version: %s" %
+                    params.get('version'))
+        lsh = cls(threshold=params['threshold'], num_perm=params['num_perm'],
+                weights=params['weights'])
+        if (lsh.b, lsh.r) != (params['b'], params['r']):
+            raise ValueError("Snapshot has b = %d, r = %d instead of %d, %d" %
+                    (params['b'], params['r'], lsh.b, lsh.r))
+        for name in cls._snapshot_arrays:
+            setattr(lsh, name, np.load(os.path.join(path,
+                name.lstrip('_') + '.npy'), mmap_mode='r' if mmap else None))
+        lsh._keys = params['keys']
+        lsh._ids = dict(zip(lsh._keys, range(len(lsh._keys))))
+        lsh._removed = np.zeros((len(lsh._keys),), dtype=np.bool_)
+        return lsh
+
+    def _find_buckets(self, band_keys):
+        '''
+        Look up the array of `band_keys` in the sorted bucket arrays.
+        Returns the indices of the band keys that have a bucket, the ids in
+        their buckets one after the other, and the bucket sizes.
+        '''
+        positions = np.minimum(np.searchsorted(self._bucket_keys, band_keys),
+                len(self._bucket_keys) - 1)
+        found = np.flatnonzero(self._bucket_keys[positions] == band_keys)
+        positions = positions[found]
+        starts = self._bucket_offsets[positions]
+        sizes = self._bucket_offsets[positions + 1] - starts
+        ends = np.cumsum(sizes)
+        # The positions in _bucket_ids of the ids in all found buckets
+        entries = np.arange(ends[-1] if len(ends) > 0 else 0) + \
+                np.repeat(starts - ends + sizes, sizes)
+        return found, self._bucket_ids[entries], sizes
+
+    def _candidate_pairs(self, signature_matrix):
+        '''
+        Find the keys sharing a bucket with every signature in
+        `signature_matrix` in at least one band. Returns the arrays of the
+        query indices and the ids of the unique (query, candidate) pairs,
+        sorted by query then id.
+        '''
+        band_keys = self._band_keys_batch(signature_matrix)
+        queries, ids = [], []
+        for j, hashtable in enumerate(self.hashtables):
+            if len(hashtable) == 0:
+                continue
+            for i, H in enumerate(band_keys[:, j].tolist()):
+                if H in hashtable:
+                    queries.append(np.full(len(hashtable[H]), i, dtype=np.int64))
+                    ids.append(np.array(hashtable[H], dtype=np.int64))
+        if len(self._bucket_keys) > 0:
+            found, bucket_ids, sizes = self._find_buckets(band_keys.ravel())
+            queries.append(np.repeat(found // self.b, sizes))
+            ids.append(bucket_ids)
+        if len(queries) == 0:
+            return np.empty((0,), dtype=np.int64), \
+                    np.empty((0,), dtype=np.int64)
+        n = len(self._keys)
+        pairs = np.unique(np.concatenate(queries) * n + np.concatenate(ids))
+        queries, ids = pairs // n, pairs % n
+        live = ~self._removed[ids]
+        return queries[live], ids[live]
+
+    def _jaccard(self, signature_matrix, queries, ids):
+        '''
+        Estimate the Jaccard similarities between the signatures in
+        `signature_matrix` at `queries` and the stored signatures at `ids`.
+        '''
+        result = np.empty(len(ids), dtype=np.float64)
+        chunk_size = max(1, _batch_max_elements // self.num_perm)
+        for start in range(0, len(ids), chunk_size):
+            end = start + chunk_size
+            result[start:end] = np.sum(signature_matrix[queries[start:end]]
+                    == self._signatures[ids[start:end]], axis=1)
+        return result / float(self.num_perm)
 
     def query(self, minhash):
         '''
         Giving the MinHash of the query dataset, retrieve 
         the keys that references datasets with Jaccard
         similarities greater than the threshold set by the index.
+        The b buckets are looked up directly in the hash tables and with
+        one binary search in the sorted bucket arrays.
         '''
-        if not isinstance(minhash, MinHash):
-            raise ValueError("minhash must be of MinHash class")
-        if len(minhash.hashvalues) != self.num_perm:
-            raise ValueError("Expecting minhash with %d permutation functions, got %d"
-                    % (self.num_perm, len(minhash.hashvalues)))
+        hashvalues = self._check(minhash)
+        band_keys = _band_keys(hashvalues, self.b, self.r)
         candidates = set()
-        for (start, end), hashtable in zip(self.hashranges, self.hashtables):
-            H = self._H(minhash.hashvalues[start:end])
-            if H in hashtable:
-                for key in hashtable[H]:
-                    candidates.add(key)
-        return list(candidates)
+        for H, hashtable in zip(band_keys.tolist(), self.hashtables):
+            bucket = hashtable.get(H)
+            if bucket is not None:
+                candidates.update(bucket)
+        if len(self._bucket_keys) > 0:
+            _, ids, _ = self._find_buckets(band_keys)
+            candidates.update(ids[~self._removed[ids]].tolist())
+        return [self._keys[i] for i in sorted(candidates)]
+
+    def query_batch(self, signature_matrix, top_k=None, min_jaccard=None):
+        '''
+        Retrieve the candidate keys for many queries at once, given their
+        MinHash signatures in `signature_matrix`: a MinHashBatch or a
+        (number of queries x num_perm) array. Returns one list of keys for
+        every query.
+        If `top_k` or `min_jaccard` is specified, the candidates are
+        re-ranked by their Jaccard similarities estimated from the stored
+        signatures, and every list contains (key, jaccard) tuples in
+        descending order of similarity: at most `top_k` of them, with
+        similarities of at least `min_jaccard`.
+        '''
+        signature_matrix = _check_signature_matrix(signature_matrix,
+                self.num_perm)
+        rerank = top_k is not None or min_jaccard is not None
+        result = []
+        chunk_size = max(1, _batch_max_elements // self.num_perm)
+        for start in range(0, len(signature_matrix), chunk_size):
+            chunk = signature_matrix[start:start+chunk_size]
+            queries, ids = self._candidate_pairs(chunk)
+            if rerank:
+                scores = self._jaccard(chunk, queries, ids)
+                if min_jaccard is not None:
+                    keep = scores >= min_jaccard
+                    queries, ids, scores = queries[keep], ids[keep], \
+                            scores[keep]
+                # Sort by query then descending similarity, and the stable
+                # sort keeps the ties in the order of ids
+                order = np.lexsort((-scores, queries))
+                queries, ids, scores = queries[order], ids[order], \
+                        scores[order]
+                if top_k is not None:
+                    ranks = np.arange(len(queries)) - \
+                            np.searchsorted(queries, queries)
+                    keep = ranks < top_k
+                    queries, ids, scores = queries[keep], ids[keep], \
+                            scores[keep]
+                scores = scores.tolist()
+            bounds = np.searchsorted(queries, np.arange(len(chunk) + 1))
+            for i in range(len(chunk)):
+                keys = [self._keys[j] for j in ids[bounds[i]:bounds[i+1]]]
+                if rerank:
+                    keys = list(zip(keys, scores[bounds[i]:bounds[i+1]]))
+                result.append(keys)
+        return result
 
+    def self_join(self, min_jaccard=None):
+        '''
+        Find all pairs of keys in the index sharing a bucket in at least
+        one band, by querying the index with its own stored signatures.
+        Every pair is returned once, as a (key1, key2) tuple with key1
+        inserted before key2.
+        If `min_jaccard` is specified, only the pairs with estimated
+        Jaccard similarities of at least `min_jaccard` are returned, as
+        (key1, key2, jaccard) tuples.
+        '''
+        signatures = self._signatures[:len(self._keys)]
+        result = []
+        chunk_size = max(1, _batch_max_elements // self.num_perm)
+        for start in range(0, len(signatures), chunk_size):
+            queries, ids = self._candidate_pairs(
+                    signatures[start:start+chunk_size])
+            queries += start
+            keep = (queries < ids) & ~self._removed[queries]
+            queries, ids = queries[keep], ids[keep]
+            keys1 = [self._keys[i] for i in queries]
+            keys2 = [self._keys[i] for i in ids]
+            if min_jaccard is None:
+                result.extend(zip(keys1, keys2))
+                continue
+            scores = self._jaccard(signatures, queries, ids)
+            keep = np.flatnonzero(scores >= min_jaccard)
+            scores = scores.tolist()
+            result.extend((keys1[i], keys2[i], scores[i]) for i in keep)
+        return result
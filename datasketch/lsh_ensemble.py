@@ -0,0 +1,169 @@
+'''
+This module implements LSHEnsemble - a MinHash index for containment
+queries: finding the sets that contain at least a fraction `threshold` of
+a query set, for sets of very different sizes. The indexed sets are
+partitioned by size, and every partition is an LSHForest, so that each
+query is answered with the (b, r) parameters that are optimal for the
+query size and the sizes in the partition.
+
+Reference: E. Zhu, F. Nargesian, K. Q. Pu, R. J. Miller, LSH Ensemble:
+Internet-Scale Domain Search, VLDB 2016.
+'''
+
+import numpy as np
+try:
+    from .minhash import MinHash
+    from .minhash_batch import MinHashBatch
+    from ._storage import _check_signature_matrix
+    from .lsh_forest import LSHForest
+except ImportError:
+    # For Python 2
+    from minhash import MinHash
+    from minhash_batch import MinHashBatch
+    from _storage import _check_signature_matrix
+    from lsh_forest import LSHForest
+
+
+# The number of Gauss-Legendre points for integrating the probabilities of
+# false positive and false negative over the containment
+_integration_points = 32
+
+
+def _containment_params(threshold, q, xs, l, k, false_positive_weight,
+        false_negative_weight):
+    '''
+    Compute the optimal (b, r) with b <= l and r <= k for containment
+    queries with the given threshold, of a query set of size `q` against
+    sets of sizes up to each of `xs`. Minimizes the weighted sum of
+    probabilities of false positive and false negative, with the Jaccard
+    similarity of a set of size x containing a fraction t of the query
+    being t*q / (x + q - t*q). Returns the arrays of b and r for `xs`.
+    '''
+    b = np.repeat(np.arange(1, l+1), k)[:, np.newaxis]
+    r = np.tile(np.arange(1, k+1), l)[:, np.newaxis]
+    x = np.asarray(xs, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    points, w = np.polynomial.legendre.leggauss(_integration_points)
+    def _integrate(f, lower, upper):
+        t = 0.5 * (upper - lower) * points + 0.5 * (upper + lower)
+        s = np.clip(t * q / (x + q - t * q), 0.0, 1.0)
+        return 0.5 * (upper - lower) * np.sum(w * f(s), axis=-1)
+    fp = _integrate(lambda s : 1 - (1 - s**r)**b, 0.0, threshold)
+    fn = _integrate(lambda s : (1 - s**r)**b, threshold, 1.0)
+    error = fp*false_positive_weight + fn*false_negative_weight
+    i = np.argmin(error, axis=1)
+    return b[i, 0], r[i, 0]
+
+
+class LSHEnsemble(object):
+    '''
+    The LSH Ensemble index for containment queries.
+    '''
+
+    # The query sizes are rounded to this geometric grid for memoizing the
+    # optimal parameters
+    _size_grid_ratio = 2.0 ** 0.125
+
+    def __init__(self, threshold=0.9, num_perm=128, num_part=16, l=32,
+            weights=(0.5,0.5)):
+        '''
+        Create an empty LSHEnsemble that accepts MinHash objects with
+        `num_perm` permutation functions and queries with containment
+        threshold `threshold`. The indexed sets are split into `num_part`
+        partitions of equal numbers of sets by size, each an LSHForest
+        with `l` trees, so the queries use up to `l` bands of up to
+        num_perm / l hash values.
+        Use `weights` to adjust the relative importance of minimizing
+        false positive and false negative, as in LSH.
+        '''
+        if threshold > 1.0 or threshold < 0.0:
+            raise ValueError("threshold must be in [0.0, 1.0]")
+        if num_part < 1:
+            raise ValueError("Must have at least one partition")
+        if any(w < 0.0 or w > 1.0 for w in weights):
+            raise ValueError("Weight must be in [0.0, 1.0]")
+        if sum(weights) != 1.0:
+            raise ValueError("Weights must sum to 1.0")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.num_part = num_part
+        self.weights = weights
+        self.forests = [LSHForest(num_perm=num_perm, l=l)
+                for _ in range(num_part)]
+        # The largest set size in every partition
+        self.uppers = np.zeros((num_part,), dtype=np.float64)
+        # The optimal (b, r) of all partitions, by rounded query size
+        self._params = dict()
+
+    def is_empty(self):
+        return all(forest.is_empty() for forest in self.forests)
+
+    def __len__(self):
+        return sum(len(forest) for forest in self.forests)
+
+    def __contains__(self, key):
+        return any(key in forest for forest in self.forests)
+
+    def index(self, keys, signature_matrix, sizes=None):
+        '''
+        Build the index from the `keys` with their MinHash signatures in
+        `signature_matrix`, a MinHashBatch or a (number of keys x num_perm)
+        array, and the sizes of their sets in `sizes`. If `sizes` is not
+        given, they are estimated from the signatures as in MinHash.count.
+        The index can only be built once, because the partitions depend on
+        the sizes of all sets.
+        '''
+        if not self.is_empty():
+            raise ValueError("The index is already built")
+        hashvalues = _check_signature_matrix(signature_matrix, self.num_perm)
+        if sizes is None:
+            sizes = MinHashBatch(hashvalues=hashvalues).count()
+        keys = list(keys)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        if len(keys) != len(hashvalues) or len(sizes) != len(keys):
+            raise ValueError("Expecting one signature and size for every key")
+        order = np.argsort(sizes, kind='mergesort')
+        for i, part in enumerate(np.array_split(order, self.num_part)):
+            if len(part) == 0:
+                continue
+            self.forests[i].bulk_insert([keys[j] for j in part],
+                    hashvalues[part])
+            self.forests[i].index()
+            self.uppers[i] = sizes[part[-1]]
+
+    def _get_params(self, size):
+        '''
+        Get the optimal (b, r) of all partitions for a query set of size
+        `size`, memoized on a geometric grid of sizes.
+        '''
+        grid = int(np.ceil(np.log(max(size, 1.0)) /
+            np.log(self._size_grid_ratio)))
+        if grid not in self._params:
+            forest = self.forests[0]
+            self._params[grid] = _containment_params(self.threshold,
+                    self._size_grid_ratio ** grid, self.uppers, forest.l,
+                    forest.k, *self.weights)
+        return self._params[grid]
+
+    def query(self, minhash, size=None):
+        '''
+        Giving the MinHash of the query set and its size, retrieve the keys
+        of the sets that contain at least a fraction `threshold` of it.
+        If `size` is not given, it is estimated as in MinHash.count.
+        The partitions of sets too small to contain the fraction of the
+        query are skipped.
+        '''
+        if not isinstance(minhash, MinHash):
+            raise ValueError("minhash must be of MinHash class")
+        if len(minhash.hashvalues) != self.num_perm:
+            raise ValueError("Expecting minhash with %d permutation functions, got %d"
+                    % (self.num_perm, len(minhash.hashvalues)))
+        if size is None:
+            size = minhash.count()
+        bs, rs = self._get_params(size)
+        result = []
+        for forest, upper, b, r in zip(self.forests, self.uppers, bs, rs):
+            if forest.is_empty() or upper < self.threshold * size:
+                continue
+            ids = forest._prefix_candidates(minhash.hashvalues, r, b)
+            result.extend(forest.keys[i] for i in ids)
+        return result
@@ -0,0 +1,192 @@
+'''
+This module implements LSHForest - a MinHash index for top-k similarity
+queries, which unlike LSH is not tuned for a Jaccard similarity threshold.
+The hash values of every signature are split into `l` trees, and each tree
+is stored as the sorted array of its hash values as byte strings, so the
+keys sharing a prefix of any length with a query are found by binary
+search.
+
+Reference: M. Bawa, T. Condie, P. Ganesan, LSH Forest: Self-Tuning
+Indexes for Similarity Search, WWW 2005.
+'''
+
+import numpy as np
+try:
+    from .minhash import MinHash
+    from ._storage import _reserve_rows, _check_signature_matrix, \
+            _add_keys
+except ImportError:
+    # For Python 2
+    from minhash import MinHash
+    from _storage import _reserve_rows, _check_signature_matrix, \
+            _add_keys
+
+
+class LSHForest(object):
+    '''
+    The LSH Forest index for top-k queries by MinHash Jaccard similarity.
+    '''
+
+    # Each hash value as a big-endian uint32, so that the byte strings of
+    # the trees sort in the lexicographic order of their hash values
+    _prefix_dtype = np.dtype('>u4')
+
+    def __init__(self, num_perm=128, l=8):
+        '''
+        Create an empty LSHForest that accepts MinHash objects with
+        `num_perm` permutation functions, split into `l` trees of
+        num_perm / l hash values each.
+        '''
+        if l <= 0 or num_perm < l:
+            raise ValueError("l must be in [1, num_perm]")
+        self.num_perm = num_perm
+        self.l = l
+        self.k = num_perm // l
+        self.keys = []
+        self._ids = dict()
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        # The number of keys in the sorted trees, the others are sorted in
+        # before the next query
+        self._indexed = 0
+        # For every tree, the sorted byte strings and their ids
+        self._trees = [np.empty((0,), dtype='S%d' % (4*self.k))
+                for _ in range(l)]
+        self._tree_ids = [np.empty((0,), dtype=np.int64) for _ in range(l)]
+
+    def is_empty(self):
+        return len(self.keys) == 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def _tree_bytes(self, values):
+        '''
+        Get the byte strings of the rows of k hash values in `values`.
+        '''
+        values = np.ascontiguousarray(values, dtype=self._prefix_dtype)
+        return values.view('S%d' % (4*self.k)).ravel()
+
+    def insert(self, key, minhash):
+        '''
+        Insert a `key` to the index, together with a `minhash` of the data
+        referenced by the `key`.
+        '''
+        if not isinstance(minhash, MinHash):
+            raise ValueError("minhash must be of MinHash class")
+        self.bulk_insert([key], minhash.hashvalues[np.newaxis, :])
+
+    def bulk_insert(self, keys, signature_matrix):
+        '''
+        Insert many `keys` to the index at once, together with their
+        MinHash signatures in `signature_matrix`: a MinHashBatch or a
+        (number of keys x num_perm) array with one signature in each row.
+        '''
+        keys = list(keys)
+        signature_matrix = _check_signature_matrix(signature_matrix,
+                self.num_perm)
+        if len(keys) != len(signature_matrix):
+            raise ValueError("Expecting one signature for every key")
+        start = _add_keys(self.keys, self._ids, keys)
+        self._signatures = _reserve_rows(self._signatures, start, len(keys))
+        self._signatures[start:start+len(keys)] = signature_matrix
+
+    def index(self):
+        '''
+        Sort the keys inserted since the last call into the trees. This is
+        done before every query, and can be called after inserting to
+        avoid the delay in the next query.
+        '''
+        if self._indexed == len(self.keys):
+            return
+        signatures = self._signatures[self._indexed:len(self.keys)]
+        ids = np.arange(self._indexed, len(self.keys), dtype=np.int64)
+        for i in range(self.l):
+            tree = np.concatenate([self._trees[i],
+                self._tree_bytes(signatures[:, i*self.k:(i+1)*self.k])])
+            tree_ids = np.concatenate([self._tree_ids[i], ids])
+            order = np.argsort(tree, kind='mergesort')
+            self._trees[i] = tree[order]
+            self._tree_ids[i] = tree_ids[order]
+        self._indexed = len(self.keys)
+
+    def _prefix_ranges(self, hashvalues):
+        '''
+        For every tree and every prefix length r in [1, k], find the range of
+        positions in the tree of the byte strings sharing their first r hash
+        values with `hashvalues`. Returns the (l x k) arrays of the starts
+        and ends of the ranges, indexed by r - 1.
+        '''
+        starts = np.empty((self.l, self.k), dtype=np.int64)
+        ends = np.empty((self.l, self.k), dtype=np.int64)
+        # The lowest and highest values after the prefix of every length
+        prefix_length = np.arange(1, self.k+1)[:, np.newaxis]
+        after_prefix = np.arange(self.k)[np.newaxis, :] >= prefix_length
+        for i in range(self.l):
+            values = np.tile(hashvalues[i*self.k:(i+1)*self.k], (self.k, 1))
+            low = np.where(after_prefix, 0, values)
+            high = np.where(after_prefix, np.iinfo(np.uint32).max, values)
+            starts[i] = np.searchsorted(self._trees[i],
+                    self._tree_bytes(low), side='left')
+            ends[i] = np.searchsorted(self._trees[i],
+                    self._tree_bytes(high), side='right')
+        return starts, ends
+
+    def _candidates(self, starts, ends, r):
+        '''
+        Get the unique ids of the keys sharing a prefix of length r with the
+        query in at least one tree.
+        '''
+        return np.unique(np.concatenate([self._tree_ids[i][starts[i, r-1]:
+            ends[i, r-1]] for i in range(self.l)]))
+
+    def _prefix_candidates(self, hashvalues, r, b):
+        '''
+        Get the unique ids of the keys sharing a prefix of length r with
+        `hashvalues` in at least one of the first `b` trees, searching only
+        for this prefix length.
+        '''
+        values = hashvalues[:b*self.k].reshape(b, self.k)
+        low = np.zeros((b, self.k), dtype=np.uint32)
+        high = np.full((b, self.k), np.iinfo(np.uint32).max, dtype=np.uint32)
+        low[:, :r] = high[:, :r] = values[:, :r]
+        low, high = self._tree_bytes(low), self._tree_bytes(high)
+        ids = [self._tree_ids[i][self._trees[i].searchsorted(low[i], 'left'):
+            self._trees[i].searchsorted(high[i], 'right')] for i in range(b)]
+        return np.unique(np.concatenate(ids))
+
+    def query(self, minhash, k):
+        '''
+        Retrieve the top-k keys most similar to the MinHash of the query
+        dataset. The longest prefix length with at least `k` candidates
+        across the trees is found by binary search, then the candidates are
+        ranked by their Jaccard similarities estimated from the stored
+        signatures. Returns up to `k` (key, jaccard) tuples in descending
+        order of similarity.
+        '''
+        if not isinstance(minhash, MinHash):
+            raise ValueError("minhash must be of MinHash class")
+        if len(minhash.hashvalues) != self.num_perm:
+            raise ValueError("Expecting minhash with %d permutation functions, got %d"
+                    % (self.num_perm, len(minhash.hashvalues)))
+        if k <= 0:
+            raise ValueError("k must be positive")
+        self.index()
+        if self.is_empty():
+            return []
+        starts, ends = self._prefix_ranges(minhash.hashvalues)
+        # The candidates only grow as the prefix gets shorter
+        low, high = 1, self.k
+        while low < high:
+            r = (low + high + 1) // 2
+            if len(self._candidates(starts, ends, r)) >= k:
+                low = r
+            else:
+                high = r - 1
+        ids = self._candidates(starts, ends, low)
+        scores = np.mean(self._signatures[ids] == minhash.hashvalues, axis=1)
+        order = np.argsort(-scores, kind='mergesort')[:k]
+        return [(self.keys[i], s) for i, s in
+                zip(ids[order], scores[order].tolist())]
@@ -7,12 +7,139 @@ http://cs.brown.edu/courses/cs253/papers/nearduplicate.pdf
 '''
 
 import random, struct
+from collections import OrderedDict
+from hashlib import sha1
 import numpy as np
 
 # http://en.wikipedia.org/wiki/Mersenne_prime
 _mersenne_prime = (1 << 61) - 1
 _max_hash = (1 << 32) - 1
 _hash_range = (1 << 32)
+# Constants used by the uint64 permutation arithmetic, as 0-dimensional
+# arrays which numpy applies to arrays faster than scalars
+_max_hash_u64 = np.array(_max_hash, dtype=np.uint64)
+_max_low_u64 = np.array((1 << 29) - 1, dtype=np.uint64)
+_one_u64 = np.array(1, dtype=np.uint64)
+_shift_29 = np.array(29, dtype=np.uint64)
+_shift_32 = np.array(32, dtype=np.uint64)
+_shift_61 = np.array(61, dtype=np.uint64)
+# The maximum number of (num_perm, seed) permutation arrays kept in the
+# cache shared by all MinHash objects
+_permutations_cache_size = 64
+_permutations_cache = OrderedDict()
+# The maximum number of elements in the (hash values x permutations)
+# matrix computed at once when updating in batch
+_batch_max_elements = 1 << 20
+# The maximum number of elements in the buffers of permuted hash values
+# reused across the chunks of a batch update
+_permute_max_elements = 1 << 16
+
+
+def _hash_values(values, hashfunc):
+    '''
+    Get the 32-bit hash values of `values` as a numpy array. `values` is
+    either a numpy array of hash values, which is used as it is, or an
+    iterable of bytes to be hashed using `hashfunc`.
+    '''
+    if isinstance(values, np.ndarray):
+        return values.astype(np.uint32, copy=False).ravel()
+    digests = b"".join(hashfunc(v).digest()[:4] for v in values)
+    return np.frombuffer(digests, dtype='<u4')
+
+
+def _get_permutations(num_perm, seed):
+    '''
+    Get the read-only (2, num_perm) array of permutation parameters for
+    `num_perm` and `seed`, from the cache if it was generated before.
+    The least recently used arrays are evicted when the cache is full.
+    '''
+    key = (num_perm, seed)
+    try:
+        permutations = _permutations_cache.pop(key)
+    except KeyError:
+        generator = random.Random()
+        generator.seed(seed)
+        # Create parameters for a random bijective permutation function
+        # that maps a 32-bit hash value to another 32-bit hash value.
+        # http://en.wikipedia.org/wiki/Universal_hashing
+        permutations = np.ascontiguousarray(np.array(
+            [(generator.randint(1, _mersenne_prime),
+              generator.randint(0, _mersenne_prime))
+             for _ in range(num_perm)], dtype=np.uint64).T)
+        permutations.flags.writeable = False
+        while len(_permutations_cache) >= _permutations_cache_size:
+            _permutations_cache.popitem(last=False)
+    _permutations_cache[key] = permutations
+    return permutations
+
+
+def _permute(hv, a, b, out=None, scratch=None):
+    '''
+    Apply the permutation functions (a * hv + b) % _mersenne_prime, with
+    parameters `a` and `b` as uint64 arrays, to the 32-bit hash values `hv`
+    and return `out`, the uint64 array holding the results in its lowest
+    32 bits.
+    The arithmetic is exact and done in place in `out` and `scratch`,
+    allocated if not given: `a` is split into its high 32 and low 29 bits,
+    so that every product and their sum fit in 64 bits, and the sum is
+    reduced using 2^61 = 1 (mod _mersenne_prime).
+    '''
+    hv = np.asarray(hv, dtype=np.uint64)
+    if out is None:
+        out = np.empty(np.broadcast(hv, a).shape, dtype=np.uint64)
+    if scratch is None:
+        scratch = np.empty_like(out)
+    # hi * 2^29 (mod prime), with hi = (a >> 29) * hv below 2^64, is the
+    # low 32 bits of hi shifted by 29 plus its high 32 bits
+    np.multiply(a >> _shift_29, hv, out=scratch)
+    np.bitwise_and(scratch, _max_hash_u64, out=out)
+    out <<= _shift_29
+    scratch >>= _shift_32
+    out += scratch
+    np.multiply(a & _max_low_u64, hv, out=scratch)
+    out += scratch
+    out += b
+    # The sum x is below 2^63, and x // prime = (x + (x >> 61) + 1) >> 61,
+    # so x % prime has the lowest 32 bits of x + x // prime
+    np.right_shift(out, _shift_61, out=scratch)
+    scratch += out
+    scratch += _one_u64
+    scratch >>= _shift_61
+    out += scratch
+    return out
+
+
+def _update_hashvalues(hashvalues, hvs, permutations):
+    '''
+    Return the element-wise minimum of `hashvalues` and the permuted
+    32-bit hash values `hvs`. The permutations are applied to chunks of
+    `hvs` at a time, in a (chunk size x num_perm) buffer reused for all
+    chunks and small enough to stay in the CPU cache.
+    '''
+    a, b = permutations
+    chunk_size = max(1, min(hvs.size,
+        _permute_max_elements // len(hashvalues)))
+    out = np.empty((chunk_size, len(hashvalues)), dtype=np.uint64)
+    scratch = np.empty_like(out)
+    hashvalues = hashvalues.astype(np.uint64)
+    for start in range(0, hvs.size, chunk_size):
+        hv = hvs[start:start+chunk_size, np.newaxis]
+        phv = _permute(hv, a, b, out[:len(hv)], scratch[:len(hv)])
+        phv &= _max_hash_u64
+        np.minimum(hashvalues, phv.min(axis=0), out=hashvalues)
+    return hashvalues.astype(np.uint32)
+
+
+def _mix64(x):
+    '''
+    Mix the bits of an array of uint64, using the finalizer of SplitMix64.
+    '''
+    x = x ^ (x >> np.uint64(30))
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
 
 
 class MinHash(object):
@@ -22,14 +149,24 @@ class MinHash(object):
 
     __slots__ = ('permutations', 'hashvalues', 'seed')
 
-    def __init__(self, num_perm=128, seed=1):
+    def __init__(self, num_perm=128, seed=1, hashvalues=None):
         '''
         Create a MinHash object with `num_perm` number of random
         permutation functions.
         The `seed` parameter controls the set of random permutation functions
         generated for this MinHash object.
         Different seed will generate different sets of permutaiton functions.
+        The permutation functions are shared by all MinHash objects with
+        the same `num_perm` and `seed`.
+        If `hashvalues` is specified, the constructor will use it as the
+        underlying hash values instead of creating new ones, and the
+        `num_perm` parameter value is ignored.
         '''
+        if hashvalues is not None:
+            if not isinstance(hashvalues, np.ndarray):
+                raise ValueError("The imported hash values must be a\
+                        numpy.ndarray.")
+            num_perm = hashvalues.size
         if num_perm <= 0:
             raise ValueError("Cannot have non-positive number of\
                     permutation functions")
@@ -38,16 +175,11 @@ class MinHash(object):
             # 2) we are using 4 bytes to store the size value
             raise ValueError("Cannot have more than %d number of\
                     permutation functions" % _hash_range)
-        self.hashvalues = np.array([_max_hash for _ in range(num_perm)])
+        if hashvalues is None:
+            hashvalues = np.full(num_perm, _max_hash, dtype=np.uint32)
+        self.hashvalues = hashvalues
         self.seed = seed
-        generator = random.Random()
-        generator.seed(self.seed)
-        # Create parameters for a random bijective permutation function
-        # that maps a 32-bit hash value to another 32-bit hash value.
-        # http://en.wikipedia.org/wiki/Universal_hashing
-        self.permutations = np.array([(generator.randint(1, _mersenne_prime),
-                                       generator.randint(0, _mersenne_prime)) 
-                                      for _ in range(num_perm)]).T
+        self.permutations = _get_permutations(num_perm, seed)
     
     def is_empty(self):
         '''
@@ -66,9 +198,22 @@ class MinHash(object):
         # Digest the hash object to get the hash value
         hv = struct.unpack('<I', hashobj.digest()[:4])[0]
         a, b = self.permutations
-        phv = np.bitwise_and((a * hv + b) % _mersenne_prime, _max_hash)
+        phv = _permute(hv, a, b).astype(np.uint32)
         self.hashvalues = np.minimum(phv, self.hashvalues)
 
+    def update_batch(self, values, hashfunc=sha1):
+        '''
+        Update this MinHash with many values at once.
+        `values` is either an iterable of bytes, each of which is hashed
+        using `hashfunc` (the first 4 bytes of the digest are used, same
+        as in `digest`), or a numpy array of 32-bit hash values.
+        The permutations are applied to chunks of hash values at a time,
+        so the memory used is bounded regardless of the number of values.
+        '''
+        hvs = _hash_values(values, hashfunc)
+        self.hashvalues = _update_hashvalues(self.hashvalues, hvs,
+                self.permutations)
+
     def merge(self, other):
         '''
         Merge the other MinHash object with this one, making this the union
@@ -88,7 +233,7 @@ class MinHash(object):
         See: http://ieeexplore.ieee.org/stamp/stamp.jsp?arnumber=365694 
         '''
         k = self.hashvalues.size
-        return np.float(k) / np.sum(self.hashvalues / np.float(_max_hash)) - 1.0
+        return float(k) / np.sum(self.hashvalues / float(_max_hash)) - 1.0
 
     def jaccard(self, other):
         '''
@@ -101,8 +246,8 @@ class MinHash(object):
         if self.hashvalues.size != other.hashvalues.size:
             raise ValueError("Cannot compute Jaccard given MinHash objects with\
                     different numbers of permutation functions")
-        return np.float(np.count_nonzero(self.hashvalues==other.hashvalues)) /\
-                np.float(self.hashvalues.size)
+        return float(np.count_nonzero(self.hashvalues==other.hashvalues)) /\
+                float(self.hashvalues.size)
 
     def bytesize(self):
         '''
@@ -125,9 +270,11 @@ class MinHash(object):
         if len(buf) < self.bytesize():
             raise ValueError("The buffer does not have enough space\
                     for holding this MinHash object.")
-        fmt = "qi%dI" % len(self.hashvalues)
-        struct.pack_into(fmt, buf, 0,
-                self.seed, len(self.hashvalues), *self.hashvalues)
+        struct.pack_into('qi', buf, 0, self.seed, len(self.hashvalues))
+        offset = struct.calcsize('qi')
+        # Write the hash values through a numpy view of the buffer
+        np.frombuffer(buf, dtype=np.uint32, count=len(self.hashvalues),
+                offset=offset)[:] = self.hashvalues
 
     @classmethod
     def deserialize(cls, buf):
@@ -140,15 +287,11 @@ class MinHash(object):
             seed, num_perm = struct.unpack_from('qi', buf, 0)
         except TypeError:
             seed, num_perm = struct.unpack_from('qi', buffer(buf), 0)
-        mh = cls(num_perm=num_perm, seed=seed)
         offset = struct.calcsize('qi')
-        try:
-            mh.hashvalues = np.array(struct.unpack_from('%dI' % num_perm,
-                buf, offset))
-        except TypeError:
-            mh.hashvalues = np.array(struct.unpack_from('%dI' % num_perm,
-                buffer(buf), offset))
-        return mh
+        # Copy, as the caller may reuse the buffer
+        hashvalues = np.frombuffer(buf, dtype=np.uint32, count=num_perm,
+                offset=offset).copy()
+        return cls(seed=seed, hashvalues=hashvalues)
 
     def __getstate__(self):
         '''
@@ -172,14 +315,11 @@ class MinHash(object):
             seed, num_perm = struct.unpack_from('qi', buf, 0)
         except TypeError:
             seed, num_perm = struct.unpack_from('qi', buffer(buf), 0)
-        self.__init__(num_perm=num_perm, seed=seed)
         offset = struct.calcsize('qi')
-        try:
-            self.hashvalues = np.array(struct.unpack_from('%dI' % num_perm,
-                buf, offset))
-        except TypeError:
-            self.hashvalues = np.array(struct.unpack_from('%dI' % num_perm,
-                buffer(buf), offset))
+        # The buffer is owned by the unpickler, so use a view of it
+        hashvalues = np.frombuffer(buf, dtype=np.uint32, count=num_perm,
+                offset=offset)
+        self.__init__(seed=seed, hashvalues=hashvalues)
 
     @classmethod
     def union(cls, *mhs):
@@ -194,9 +334,8 @@ class MinHash(object):
                 any(num_perm != m.hashvalues.size for m in mhs):
             raise ValueError("The unioning MinHash objects must have the\
                     same seed and number of permutation functions")
-        mh = cls(num_perm=num_perm, seed=seed)
-        mh.hashvalues = np.minimum.reduce([m.hashvalues for m in mhs])
-        return mh
+        hashvalues = np.minimum.reduce([m.hashvalues for m in mhs])
+        return cls(seed=seed, hashvalues=hashvalues)
 
     def __eq__(self, other):
         '''
@@ -222,12 +361,26 @@ def jaccard(*mhs):
                 different numbers of permutation functions")
     if len(mhs) == 2:
         m1, m2 = mhs
-        return np.float(np.count_nonzero(m1.hashvalues == m2.hashvalues)) /\
-                np.float(m1.hashvalues.size)
-    # TODO: find a way to compute intersection for more than 2 using numpy
-    intersection = 0
-    for i in range(num_perm):
-        phv = mhs[0].hashvalues[i]
-        if all(phv == m.hashvalues[i] for m in mhs):
-            intersection += 1
+        return float(np.count_nonzero(m1.hashvalues == m2.hashvalues)) /\
+                float(m1.hashvalues.size)
+    intersection = np.count_nonzero(_intersection(mhs))
     return float(intersection) / float(num_perm)
+
+
+def _intersection(mhs, chunk_size=None):
+    '''
+    Return a boolean array marking the permutation functions for which
+    all the MinHash objects `mhs` have the same hash value.
+    The hash values are stacked and compared `chunk_size` MinHash objects
+    at a time, chosen to bound the size of the stacked array if not given.
+    '''
+    first = mhs[0].hashvalues
+    if chunk_size is None:
+        chunk_size = max(1, _batch_max_elements // first.size)
+    mask = np.ones(first.size, dtype=bool)
+    for start in range(1, len(mhs), chunk_size):
+        stacked = np.vstack([m.hashvalues for m in mhs[start:start+chunk_size]])
+        mask &= np.all(stacked == first, axis=0)
+        if not mask.any():
+            break
+    return mask
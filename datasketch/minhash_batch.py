@@ -0,0 +1,250 @@
+'''
+This module implements MinHashBatch - a collection of MinHash signatures
+stored together as one (number of signatures x num_perm) matrix, so that
+Jaccard similarities across many datasets are computed with vectorized
+operations instead of one pair of MinHash objects at a time.
+'''
+
+import struct
+from hashlib import sha1
+import numpy as np
+try:
+    from .minhash import MinHash, _max_hash, _batch_max_elements, \
+            _get_permutations, _hash_values, _update_hashvalues
+    from ._storage import _reserve_rows
+except ImportError:
+    # For Python 2
+    from minhash import MinHash, _max_hash, _batch_max_elements, \
+            _get_permutations, _hash_values, _update_hashvalues
+    from _storage import _reserve_rows
+
+
+class MinHashBatch(object):
+    '''
+    The MinHashBatch object, holding many MinHash signatures with the same
+    seed and number of permutation functions.
+    '''
+
+    __slots__ = ('seed', 'permutations', '_hashvalues', '_size')
+
+    # seed as int64
+    # num_perm as int32
+    # number of signatures as int64
+    _serial_fmt_header = '<qiq'
+    # each hash value as little-endian uint32
+    _serial_dtype = np.dtype('<u4')
+
+    def __init__(self, num_perm=128, seed=1, hashvalues=None):
+        '''
+        Create an empty MinHashBatch for signatures with `num_perm`
+        permutation functions generated from `seed`, as in MinHash.
+        If `hashvalues` is specified, it must be a 2-dimensional
+        numpy.ndarray with one signature in each row, which will be
+        used as the underlying matrix, and the `num_perm` parameter
+        value is ignored.
+        '''
+        if hashvalues is None:
+            if num_perm <= 0:
+                raise ValueError("Cannot have non-positive number of\
+                        permutation functions")
+            hashvalues = np.empty((0, num_perm), dtype=np.uint32)
+        else:
+            if not isinstance(hashvalues, np.ndarray) or \
+                    hashvalues.ndim != 2:
+                raise ValueError("The imported hash values must be a\
+                        2-dimensional numpy.ndarray.")
+            num_perm = hashvalues.shape[1]
+        self.seed = seed
+        self.permutations = _get_permutations(num_perm, seed)
+        self._hashvalues = hashvalues
+        self._size = hashvalues.shape[0]
+
+    @property
+    def hashvalues(self):
+        '''
+        The (number of signatures x num_perm) matrix of hash values.
+        '''
+        return self._hashvalues[:self._size]
+
+    @property
+    def num_perm(self):
+        return self._hashvalues.shape[1]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        '''
+        Get the i-th signature as a MinHash object. Its hash values are a
+        view of the row in this batch, until the MinHash is updated.
+        '''
+        if not -self._size <= i < self._size:
+            raise IndexError("MinHashBatch index out of range")
+        return MinHash(seed=self.seed, hashvalues=self.hashvalues[i])
+
+    def _reserve(self, n):
+        '''
+        Make room for `n` more signatures and return the index of the
+        first one.
+        '''
+        start = self._size
+        self._hashvalues = _reserve_rows(self._hashvalues, start, n)
+        self._size += n
+        return start
+
+    def _check(self, minhash):
+        if minhash.seed != self.seed:
+            raise ValueError("Cannot use MinHash objects with\
+                    different seeds")
+        if minhash.hashvalues.size != self.num_perm:
+            raise ValueError("Cannot use MinHash objects with\
+                    different numbers of permutation functions")
+
+    def add(self, minhash):
+        '''
+        Append the signature of the MinHash object `minhash` to the batch,
+        and return its index.
+        '''
+        self._check(minhash)
+        i = self._reserve(1)
+        self._hashvalues[i] = minhash.hashvalues
+        return i
+
+    def add_documents(self, documents, hashfunc=sha1):
+        '''
+        Compute the signatures of `documents` and append them to the batch.
+        Each document is either an iterable of bytes, hashed using
+        `hashfunc`, or a numpy array of 32-bit hash values, same as the
+        input to MinHash.update_batch.
+        Returns the indices of the new signatures.
+        '''
+        rows = []
+        for document in documents:
+            hashvalues = np.full(self.num_perm, _max_hash, dtype=np.uint32)
+            hvs = _hash_values(document, hashfunc)
+            rows.append(_update_hashvalues(hashvalues, hvs,
+                self.permutations))
+        start = self._reserve(len(rows))
+        if rows:
+            self._hashvalues[start:self._size] = rows
+        return np.arange(start, self._size)
+
+    def count(self):
+        '''
+        Estimate the cardinality count of every signature.
+        '''
+        return float(self.num_perm) / np.sum(self.hashvalues /
+                float(_max_hash), axis=1) - 1.0
+
+    def jaccard(self, other):
+        '''
+        Estimate the Jaccard similarities between the MinHash `other`
+        and every signature in the batch.
+        '''
+        self._check(other)
+        hashvalues = self.hashvalues
+        result = np.empty(len(hashvalues), dtype=np.float64)
+        chunk_size = max(1, _batch_max_elements // self.num_perm)
+        for start in range(0, len(hashvalues), chunk_size):
+            chunk = hashvalues[start:start+chunk_size]
+            result[start:start+len(chunk)] = \
+                    np.sum(chunk == other.hashvalues, axis=1)
+        return result / float(self.num_perm)
+
+    def jaccard_matrix(self, other=None, block_size=None):
+        '''
+        Estimate the Jaccard similarities between all pairs of signatures
+        in this batch and in the MinHashBatch `other` (this batch itself
+        if not given). Returns a (len(self) x len(other)) matrix.
+        The matrix is computed in square blocks of `block_size` signatures,
+        chosen to bound the size of the temporary arrays if not given.
+        '''
+        if other is None:
+            other = self
+        if other.seed != self.seed or other.num_perm != self.num_perm:
+            raise ValueError("Cannot compare MinHashBatch objects with\
+                    different seeds or numbers of permutation functions")
+        if block_size is None:
+            block_size = max(1, int(np.sqrt(_batch_max_elements //
+                self.num_perm)))
+        h1, h2 = self.hashvalues, other.hashvalues
+        result = np.empty((len(h1), len(h2)), dtype=np.float64)
+        for i in range(0, len(h1), block_size):
+            b1 = h1[i:i+block_size, np.newaxis, :]
+            for j in range(0, len(h2), block_size):
+                b2 = h2[np.newaxis, j:j+block_size, :]
+                result[i:i+block_size, j:j+block_size] = \
+                        np.sum(b1 == b2, axis=2)
+        return result / float(self.num_perm)
+
+    def bytesize(self):
+        '''
+        Get the serialized size of this MinHashBatch in number of bytes.
+        '''
+        return struct.calcsize(self._serial_fmt_header) + \
+                self._serial_dtype.itemsize * self.hashvalues.size
+
+    def serialize(self, buf):
+        '''
+        Serialize this MinHashBatch into bytes, store in `buf`.
+        The format is a header with the seed, num_perm and number of
+        signatures, followed by the signatures back to back as a raw
+        block of little-endian uint32.
+        '''
+        if len(buf) < self.bytesize():
+            raise ValueError("The buffer does not have enough space\
+                    for holding this MinHashBatch.")
+        struct.pack_into(self._serial_fmt_header, buf, 0, self.seed,
+                self.num_perm, len(self))
+        offset = struct.calcsize(self._serial_fmt_header)
+        np.frombuffer(buf, dtype=self._serial_dtype,
+                count=self.hashvalues.size, offset=offset)[:] = \
+                        self.hashvalues.ravel()
+
+    @classmethod
+    def deserialize(cls, buf):
+        '''
+        Reconstruct a MinHashBatch from bytes in `buf`, without copying:
+        the hash values are a view of the buffer.
+        '''
+        try:
+            seed, num_perm, size = struct.unpack_from(cls._serial_fmt_header,
+                    buf, 0)
+        except TypeError:
+            seed, num_perm, size = struct.unpack_from(cls._serial_fmt_header,
+                    buffer(buf), 0)
+        offset = struct.calcsize(cls._serial_fmt_header)
+        hashvalues = np.frombuffer(buf, dtype=cls._serial_dtype,
+                count=size*num_perm, offset=offset)
+        return cls(seed=seed, hashvalues=hashvalues.reshape(size, num_perm))
+
+    def save(self, path):
+        '''
+        Save this MinHashBatch to the file `path`, in the same format
+        as `serialize`.
+        '''
+        with open(path, 'wb') as f:
+            f.write(struct.pack(self._serial_fmt_header, self.seed,
+                self.num_perm, len(self)))
+            self.hashvalues.astype(self._serial_dtype, copy=False).tofile(f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load a MinHashBatch saved in the file `path`. If `mmap` is True,
+        the file is memory-mapped read-only instead of being read, so
+        opening a large file is fast and the signatures are only read
+        from the disk when used. Adding signatures to a memory-mapped
+        batch first copies it into memory.
+        '''
+        header_size = struct.calcsize(cls._serial_fmt_header)
+        with open(path, 'rb') as f:
+            seed, num_perm, size = struct.unpack(cls._serial_fmt_header,
+                    f.read(header_size))
+            if mmap:
+                hashvalues = np.memmap(f, dtype=cls._serial_dtype, mode='r',
+                        offset=header_size, shape=(size, num_perm))
+            else:
+                hashvalues = np.fromfile(f, dtype=cls._serial_dtype,
+                        count=size*num_perm).reshape(size, num_perm)
+        return cls(seed=seed, hashvalues=hashvalues)
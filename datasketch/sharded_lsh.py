@@ -0,0 +1,353 @@
+'''
+This module implements ShardedLSH - a MinHash LSH index partitioned by
+key across worker processes. Every worker holds an LSH index over its
+share of the keys, so building and querying run on all cores and the
+index is not bounded by the memory of one process. Signature matrices
+are passed to the workers through shared memory when available.
+'''
+
+import multiprocessing
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # For Python 2 and Python 3 before 3.8, the arrays are pickled
+    shared_memory = None
+try:
+    from .lsh import LSH, _optimal_param
+    from ._storage import _check_signature_matrix, _check_new_keys
+except ImportError:
+    # For Python 2
+    from lsh import LSH, _optimal_param
+    from _storage import _check_signature_matrix, _check_new_keys
+
+
+class _SharedArray(object):
+    '''
+    A reference to an array in shared memory, sent to the workers instead
+    of the array itself. The workers see the rows selected by `index`.
+    '''
+
+    def __init__(self, name, shape, dtype, index=slice(None)):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.index = index
+
+    def attach(self):
+        '''
+        Attach to the shared memory, and return it with the view of the
+        selected rows of the array.
+        '''
+        shm = shared_memory.SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        return shm, array[self.index]
+
+
+def _call_all(lsh, calls):
+    '''
+    Call the methods of `lsh` in the list of (method name, arguments)
+    `calls` in order, and raise the first error once all are done.
+    '''
+    errors = []
+    for method, args in calls:
+        try:
+            getattr(lsh, method)(*args)
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def _worker(conn, threshold, num_perm, weights):
+    '''
+    The loop of a worker process: call the methods of its LSH index as
+    requested by the (method name, arguments, keyword arguments) messages
+    from `conn`, and send back (result, exception) until the method name
+    is None. The method name '_call_all' runs a list of buffered calls.
+    '''
+    lsh = LSH(threshold=threshold, num_perm=num_perm, weights=weights)
+    while True:
+        method, args, kwargs = conn.recv()
+        if method is None:
+            break
+        shms = []
+        try:
+            for name, arg in kwargs.items():
+                if isinstance(arg, _SharedArray):
+                    shm, kwargs[name] = arg.attach()
+                    shms.append(shm)
+            if method == '_call_all':
+                result, error = _call_all(lsh, *args), None
+            else:
+                result, error = getattr(lsh, method)(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+        # Release the views before closing the shared memory
+        kwargs = None
+        for shm in shms:
+            shm.close()
+        conn.send((result, error))
+    conn.close()
+
+
+class ShardedLSH(object):
+    '''
+    The MinHash LSH index sharded across worker processes, with the same
+    interface for inserting, removing and querying keys as LSH.
+    Inserting, removing and updating single keys only buffers the calls
+    for their shards, which are sent together, but every single query is
+    a round trip to all shards: only `bulk_insert` and `query_batch`
+    spread their work over the shards in parallel and scale with them.
+    '''
+
+    # The number of buffered calls of a shard at which the buffers of all
+    # shards are sent
+    _max_buffered = 256
+
+    def __init__(self, threshold=0.9, num_perm=128, weights=(0.5,0.5),
+            num_shards=None):
+        '''
+        Create an empty index with the parameters of LSH, partitioned into
+        `num_shards` worker processes, by default one for each CPU.
+        '''
+        if num_shards is None:
+            num_shards = multiprocessing.cpu_count()
+        if num_shards < 1:
+            raise ValueError("Must have at least one shard")
+        # An empty index, which checks the parameters before starting the
+        # workers and the MinHashes before buffering them
+        self._empty = LSH(threshold=threshold, num_perm=num_perm,
+                weights=weights)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.weights = weights
+        self.b, self.r = _optimal_param(threshold, num_perm, *weights)
+        # The shard of every key, with new keys assigned in turn
+        self._shards = dict()
+        self._next_shard = 0
+        self._conns = []
+        self._workers = []
+        # The (method name, arguments) calls buffered for every shard
+        self._buffers = [[] for _ in range(num_shards)]
+        if shared_memory is not None:
+            # Share the resource tracker of this process with the workers,
+            # which then do not track the shared memory this process unlinks
+            resource_tracker.ensure_running()
+        for _ in range(num_shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker,
+                    args=(worker_conn, threshold, num_perm, weights))
+            worker.daemon = True
+            worker.start()
+            self._conns.append(conn)
+            self._workers.append(worker)
+
+    @property
+    def num_shards(self):
+        return len(self._conns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Stop the worker processes, after sending the buffered calls. The
+        index cannot be used afterwards.
+        '''
+        try:
+            self.flush()
+        finally:
+            for conn in self._conns:
+                conn.send((None, None, None))
+                conn.close()
+            for worker in self._workers:
+                worker.join()
+            self._conns = []
+            self._workers = []
+
+    def _buffer(self, shard, method, *args):
+        '''
+        Buffer the call of `method` of the LSH index in `shard` with
+        `args`, and send the buffers once it has enough calls.
+        '''
+        self._buffers[shard].append((method, args))
+        if len(self._buffers[shard]) >= self._max_buffered:
+            self.flush()
+
+    def flush(self):
+        '''
+        Send the buffered inserts, removals and updates to their shards,
+        which run them in parallel, and wait for them. Raises the first
+        error of the buffered calls. Every other method of the index
+        flushes the buffers first.
+        '''
+        shards = [shard for shard, calls in enumerate(self._buffers) if calls]
+        for shard in shards:
+            self._conns[shard].send(('_call_all', (self._buffers[shard],), {}))
+            self._buffers[shard] = []
+        self._receive(shards)
+
+    def _receive(self, shards):
+        '''
+        Receive the results of the calls sent to `shards`, in the same
+        order, and raise the first error if any.
+        '''
+        results = [self._conns[shard].recv() for shard in shards]
+        for _, error in results:
+            if error is not None:
+                raise error
+        return [result for result, _ in results]
+
+    def _call(self, shards, method, *args):
+        '''
+        Call `method` of the LSH indexes in `shards` with `args`, which are
+        sent to all of them first so that they run in parallel.
+        Returns the results in the same order.
+        '''
+        self.flush()
+        for shard in shards:
+            self._conns[shard].send((method, args, {}))
+        return self._receive(shards)
+
+    def _call_with_array(self, method, name, array, indexes, kwargs):
+        '''
+        Call `method` of the LSH index of every shard with the rows
+        `indexes[shard]` of `array` as the keyword argument `name`, and
+        the other keyword arguments `kwargs[shard]`. The array is copied
+        once into shared memory if available, instead of being pickled to
+        every worker.
+        '''
+        self.flush()
+        shards = range(self.num_shards)
+        if shared_memory is None:
+            for shard in shards:
+                kwargs[shard][name] = array[indexes[shard]]
+                self._conns[shard].send((method, (), kwargs[shard]))
+            return self._receive(shards)
+        else:
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True,
+                    size=max(1, array.nbytes))
+            try:
+                np.ndarray(array.shape, dtype=array.dtype,
+                        buffer=shm.buf)[:] = array
+                for shard in shards:
+                    kwargs[shard][name] = _SharedArray(shm.name, array.shape,
+                            array.dtype, indexes[shard])
+                    self._conns[shard].send((method, (), kwargs[shard]))
+                return self._receive(shards)
+            finally:
+                shm.close()
+                shm.unlink()
+
+    def is_empty(self):
+        return len(self._shards) == 0
+
+    def __len__(self):
+        return len(self._shards)
+
+    def __contains__(self, key):
+        return key in self._shards
+
+    def insert(self, key, minhash):
+        '''
+        Insert a `key` to the index, together with a `minhash` of the data
+        referenced by the `key`, in the next shard. The MinHash is checked
+        in this process and the insert is buffered, see `flush`.
+        '''
+        self._empty._check(minhash)
+        if key in self._shards:
+            raise ValueError("The given key already exists")
+        shard = self._next_shard
+        self._buffer(shard, 'insert', key, minhash)
+        self._shards[key] = shard
+        self._next_shard = (shard + 1) % self.num_shards
+
+    def bulk_insert(self, keys, signature_matrix):
+        '''
+        Insert many `keys` to the index at once, together with their
+        MinHash signatures in `signature_matrix`, as in LSH.bulk_insert.
+        The keys are dealt to the shards in turn, which build their
+        buckets in parallel.
+        '''
+        keys = list(keys)
+        signature_matrix = _check_signature_matrix(signature_matrix,
+                self.num_perm)
+        if len(keys) != len(signature_matrix):
+            raise ValueError("Expecting one signature for every key")
+        _check_new_keys(keys, self._shards)
+        n = self.num_shards
+        # The i-th key goes to the shard (next shard + i) % n
+        indexes = [slice((shard - self._next_shard) % n, None, n)
+                for shard in range(n)]
+        self._call_with_array('bulk_insert', 'signature_matrix',
+                signature_matrix, indexes,
+                [{'keys': keys[index]} for index in indexes])
+        for shard, index in enumerate(indexes):
+            self._shards.update((key, shard) for key in keys[index])
+        self._next_shard = (self._next_shard + len(keys)) % n
+
+    def remove(self, key):
+        '''
+        Remove the `key` from the index. The removal is buffered, see
+        `flush`.
+        '''
+        if key not in self._shards:
+            raise ValueError("The given key does not exist")
+        self._buffer(self._shards.pop(key), 'remove', key)
+
+    def update(self, key, minhash):
+        '''
+        Replace the MinHash of the `key` in the index with `minhash`, or
+        insert the `key` if it is not in the index. The update is
+        buffered, see `flush`.
+        '''
+        if key not in self._shards:
+            self.insert(key, minhash)
+        else:
+            self._empty._check(minhash)
+            self._buffer(self._shards[key], 'update', key, minhash)
+
+    def compact(self):
+        '''
+        Compact the LSH indexes of all shards in parallel, as in
+        LSH.compact.
+        '''
+        self._call(range(self.num_shards), 'compact')
+
+    def query(self, minhash):
+        '''
+        Giving the MinHash of the query dataset, retrieve the keys from all
+        shards that references datasets with Jaccard similarities greater
+        than the threshold set by the index. Every query waits for all
+        shards, so many queries are best answered at once by `query_batch`.
+        '''
+        results = self._call(range(self.num_shards), 'query', minhash)
+        return [key for result in results for key in result]
+
+    def query_batch(self, signature_matrix, top_k=None, min_jaccard=None):
+        '''
+        Retrieve the candidate keys for many queries at once, as in
+        LSH.query_batch. Every shard answers all queries in parallel, and
+        their results are merged: with `top_k` or `min_jaccard`, the merged
+        (key, jaccard) tuples are sorted and cut to `top_k` again.
+        '''
+        signature_matrix = _check_signature_matrix(signature_matrix,
+                self.num_perm)
+        n = self.num_shards
+        results = self._call_with_array('query_batch', 'signature_matrix',
+                signature_matrix, [slice(None)] * n,
+                [{'top_k': top_k, 'min_jaccard': min_jaccard}
+                    for _ in range(n)])
+        merged = []
+        for candidates in zip(*results):
+            candidates = [c for shard in candidates for c in shard]
+            if top_k is not None or min_jaccard is not None:
+                candidates.sort(key=lambda c: c[1], reverse=True)
+                candidates = candidates[:top_k]
+            merged.append(candidates)
+        return merged
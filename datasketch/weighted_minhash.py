@@ -0,0 +1,166 @@
+'''
+This module implements WeightedMinHash - a sketch of a weighted set, whose
+collision rate estimates the generalized (weighted) Jaccard similarity
+sum(min(w1, w2)) / sum(max(w1, w2)), using Improved Consistent Weighted
+Sampling (ICWS).
+
+Reference: S. Ioffe, Improved Consistent Sampling, Weighted Minhash and
+L1 Sketching, ICDM 2010.
+'''
+
+import numpy as np
+try:
+    from .minhash import _batch_max_elements, _mix64
+except ImportError:
+    # For Python 2
+    from minhash import _batch_max_elements, _mix64
+
+
+# The number of 64-bit random values used by ICWS for every sample and
+# element, each split into two uniform values: one for each of the
+# Gamma(2, 1) values r and c, and one for beta
+_num_streams = 3
+# The increment of SplitMix64, separating the random values of different
+# samples and streams
+_golden_gamma = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _uniforms(base, stream, samples):
+    '''
+    Get two (samples x elements) matrices of uniform random values in
+    (0, 1) of the stream `stream`, from the high and low 32 bits of a hash
+    of the sample, the stream and `base`, the hashes of the seed and the
+    element indices. The same element always gets the same values without
+    storing them.
+    '''
+    offsets = (samples.astype(np.uint64) * np.uint64(_num_streams) +
+            np.uint64(stream + 1)) * _golden_gamma
+    x = _mix64(base[np.newaxis, :] + offsets[:, np.newaxis])
+    high = (x >> np.uint64(32)).astype(np.float64)
+    low = (x & np.uint64(0xffffffff)).astype(np.float64)
+    return (high + 0.5) * 2.0**-32, (low + 0.5) * 2.0**-32
+
+
+class WeightedMinHash(object):
+    '''
+    The WeightedMinHash object, holding the sampled (index, t) pair of
+    every sample as the rows of `hashvalues`.
+    '''
+
+    __slots__ = ('seed', 'hashvalues')
+
+    def __init__(self, seed, hashvalues):
+        '''
+        Create a WeightedMinHash object from the (sample_size x 2) array
+        `hashvalues` generated with `seed`. Use WeightedMinHashGenerator
+        to sketch weighted sets.
+        '''
+        self.seed = seed
+        self.hashvalues = hashvalues
+
+    def __len__(self):
+        return len(self.hashvalues)
+
+    def __eq__(self, other):
+        return self.seed == other.seed and \
+                np.array_equal(self.hashvalues, other.hashvalues)
+
+    def jaccard(self, other):
+        '''
+        Estimate the weighted Jaccard similarity between this
+        WeightedMinHash and the other.
+        '''
+        if other.seed != self.seed:
+            raise ValueError("Cannot compute Jaccard given WeightedMinHash objects with\
+                    different seeds")
+        if len(self) != len(other):
+            raise ValueError("Cannot compute Jaccard given WeightedMinHash objects with\
+                    different numbers of samples")
+        same = np.all(self.hashvalues == other.hashvalues, axis=1)
+        return float(np.count_nonzero(same)) / float(len(self))
+
+    def digest(self):
+        '''
+        Fold every sampled (index, t) pair into a 32-bit hash value. The
+        folded values collide at the same rate up to 2^-32, so they can be
+        used as the hash values of a MinHash: in LSH, or as the rows of a
+        MinHashBatch for batch similarities.
+        '''
+        k = self.hashvalues[:, 0].astype(np.uint64)
+        t = self.hashvalues[:, 1].astype(np.uint64)
+        return (_mix64(_mix64(k) ^ t) >> np.uint64(32)).astype(np.uint32)
+
+
+class WeightedMinHashGenerator(object):
+    '''
+    The generator of WeightedMinHash objects with the same seed and sample
+    size. The random values of ICWS are hashed from the element indices
+    instead of being drawn for every dimension, so the indices can be any
+    64-bit integers, such as ids of songs.
+    '''
+
+    def __init__(self, sample_size=128, seed=1):
+        '''
+        Create a generator of WeightedMinHash objects with `sample_size`
+        samples, using the random values generated from `seed`.
+        '''
+        if sample_size <= 0:
+            raise ValueError("Cannot have non-positive sample size")
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def minhash(self, indices, weights):
+        '''
+        Sketch the weighted set given by the arrays of its element `indices`
+        and their positive `weights`. The weights of repeated indices are
+        added, and elements with non-positive weights are ignored.
+        The samples are computed in chunks, as (chunk size x number of
+        elements) matrices.
+        '''
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        if indices.shape != weights.shape:
+            raise ValueError("Expecting one weight for every index")
+        indices, inverse = np.unique(indices, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=weights,
+                minlength=len(indices))
+        indices, weights = indices[weights > 0], weights[weights > 0]
+        if len(indices) == 0:
+            raise ValueError("Cannot sketch a weighted set without positive\
+                    weights")
+        log_weights = np.log(weights)
+        base = _mix64(indices.astype(np.uint64) ^ _mix64(np.array([self.seed],
+            dtype=np.uint64)))
+        hashvalues = np.empty((self.sample_size, 2), dtype=np.int64)
+        chunk_size = max(1, _batch_max_elements // len(indices))
+        for start in range(0, self.sample_size, chunk_size):
+            samples = np.arange(start, min(start + chunk_size,
+                self.sample_size))
+            # r and c follow Gamma(2, 1) and beta follows Uniform(0, 1)
+            u1, u2 = _uniforms(base, 0, samples)
+            r = -np.log(u1 * u2)
+            u1, u2 = _uniforms(base, 1, samples)
+            c = -np.log(u1 * u2)
+            beta, _ = _uniforms(base, 2, samples)
+            t = np.floor(log_weights / r + beta)
+            log_y = r * (t - beta)
+            log_a = np.log(c) - log_y - r
+            best = np.argmin(log_a, axis=1)
+            rows = np.arange(len(samples))
+            hashvalues[samples, 0] = indices[best]
+            hashvalues[samples, 1] = t[rows, best]
+        return WeightedMinHash(self.seed, hashvalues)
+
+    def signature_matrix(self, documents):
+        '''
+        Sketch many weighted sets, each given as a pair of the arrays of
+        indices and weights as in `minhash`, and return the digests of the
+        sketches as a (number of sets x sample_size) matrix of 32-bit hash
+        values. The matrix can be inserted and queried in LSH with
+        num_perm = sample_size, and compared in batch as a MinHashBatch.
+        '''
+        rows = [self.minhash(indices, weights).digest()
+                for indices, weights in documents]
+        if len(rows) == 0:
+            return np.empty((0, self.sample_size), dtype=np.uint32)
+        return np.vstack(rows)
@@ -5,7 +5,9 @@ Some examples for LSH
 from hashlib import sha1
 import numpy as np
 from datasketch.minhash import MinHash
-from datasketch.lsh import MinHashLSH
+from datasketch.minhash_batch import MinHashBatch
+from datasketch.lsh import LSH
+from datasketch.lsh_forest import LSHForest
 from os import listdir, path
 
 import sys
@@ -23,30 +25,41 @@ class SimilarityForFiles:
             self.min_hash_dict[file_name] = set(self.file_to_words('/'.join([self.doc_dir, file_name])))
 
         self.min_hash_dict = {k: self.min_hash_text(v) for k, v in self.min_hash_dict.iteritems()}
-        #self.lsh = MinHashLSH(threshold=0)
-
-        #for k, v in self.min_hash_dict.iteritems():
-         #   self.lsh.insert(k, v)
+        # All the signatures in one batch, in the order of the keys, shared
+        # by the indexes and the Jaccard estimates
+        self.keys = list(self.min_hash_dict.iterkeys())
+        self.batch = MinHashBatch()
+        for k in self.keys:
+            self.batch.add(self.min_hash_dict[k])
+        # One index per threshold, built once with all the signatures
+        self.lsh = {}
+        # The top-k index does not depend on a threshold
+        self.forest = LSHForest()
+        self.forest.bulk_insert(self.keys, self.batch)
 
     def find_more_then_threshold(self, threshold, curr_file_name):
-        lsh = MinHashLSH(threshold)
+        if threshold not in self.lsh:
+            self.lsh[threshold] = LSH(threshold)
+            self.lsh[threshold].bulk_insert(self.keys, self.batch)
         current_m = self.min_hash_text(set(self.file_to_words('/'.join([self.doc_dir, curr_file_name]))))
-        for k, v in self.min_hash_dict.iteritems():
-            lsh.insert(k, v)
-        result = lsh.query(current_m)
+        result = self.lsh[threshold].query(current_m)
         print("Candidates with Jaccard similarity > " + str(threshold), result)
 
+    def find_most_similar(self, k, curr_file_name):
+        current_m = self.min_hash_text(set(self.file_to_words('/'.join([self.doc_dir, curr_file_name]))))
+        result = self.forest.query(current_m, k)
+        print("Top " + str(k) + " candidates with their Jaccard similarities", result)
+
     def show_result(self, curr_file_name):
         #current_m = self.min_hash_text(self.file_to_words('/'.join([self.doc_dir, curr_file_name])))
         current_m = self.min_hash_dict[curr_file_name]
-        for k, v in self.min_hash_dict.iteritems():
-            print"Estimated Jaccard for " + curr_file_name + " and " + k +" is ", current_m.jaccard(v)
+        for k, j in zip(self.keys, self.batch.jaccard(current_m)):
+            print"Estimated Jaccard for " + curr_file_name + " and " + k +" is ", j
 
 
     def min_hash_text(self, sm_text):
         m = MinHash()
-        for d in sm_text:
-            m.update(d.encode('utf8'))
+        m.update_batch(d.encode('utf8') for d in sm_text)
         return m
 
     def file_to_words(self, file_name):
@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+from datasketch import HyperLogLog, HyperLogLogPlusPlus
+
+
+class TestHyperLogLogDeserialize(unittest.TestCase):
+
+    def _serialized(self):
+        h = HyperLogLog(p=4)
+        h.update_batch([b"a", b"b", b"c"])
+        buf = bytearray(h.bytesize())
+        h.serialize(buf)
+        return h, buf
+
+    def test_deserialize_copy(self):
+        h, buf = self._serialized()
+        h2 = HyperLogLog.deserialize(buf)
+        buf[1:] = bytearray(len(buf) - 1)
+        self.assertTrue(np.array_equal(h2.reg, h.reg))
+        self.assertTrue(h2.reg.flags.writeable)
+
+    def test_deserialize_view(self):
+        h, buf = self._serialized()
+        h2 = HyperLogLog.deserialize(buf, copy=False)
+        self.assertFalse(h2.reg.flags.writeable)
+        h2.update_batch([b"d", b"e"])
+        self.assertTrue(np.array_equal(HyperLogLog.deserialize(buf).reg,
+            h.reg))
+
+    def test_setstate_copy(self):
+        h, buf = self._serialized()
+        h2 = HyperLogLog.__new__(HyperLogLog)
+        h2.__setstate__(buf)
+        buf[1:] = bytearray(len(buf) - 1)
+        self.assertTrue(np.array_equal(h2.reg, h.reg))
+
+
+class TestHyperLogLogPlusPlusSparse(unittest.TestCase):
+
+    def _sketch(self, values):
+        h = HyperLogLogPlusPlus(p=8, sparse=True)
+        h.update_batch(values)
+        return h
+
+    def test_merge_empty(self):
+        h1, h2 = self._sketch([]), self._sketch([])
+        h1.merge(h2)
+        self.assertTrue(h1.is_sparse())
+        self.assertTrue(h1.is_empty())
+        self.assertEqual(h1.count(), 0.0)
+
+    def test_merge_empty_non_empty(self):
+        values = [b"a", b"b", b"c"]
+        h1, h2 = self._sketch([]), self._sketch(values)
+        h1.merge(h2)
+        self.assertTrue(h1 == self._sketch(values))
+        h3 = self._sketch(values)
+        h3.merge(self._sketch([]))
+        self.assertTrue(h3 == self._sketch(values))
+
+    def test_union_empty(self):
+        h = HyperLogLogPlusPlus.union(self._sketch([]), self._sketch([]))
+        self.assertTrue(h.is_sparse())
+        self.assertTrue(h.is_empty())
+
+    def test_union_empty_non_empty(self):
+        values = [b"a", b"b", b"c"]
+        h = HyperLogLogPlusPlus.union(self._sketch([]), self._sketch(values))
+        self.assertTrue(h == self._sketch(values))
+        self.assertTrue(np.array_equal(h._get_reg(),
+            self._sketch(values)._get_reg()))
+
+
+if __name__ == "__main__":
+    unittest.main()